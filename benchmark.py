@@ -0,0 +1,597 @@
+#!/usr/bin/env python3
+
+# Measures the hot paths of the capture, clean and convert commands on
+# synthetic frames, and prints the results as JSON so that runs from
+# different commits can be compared. Nothing here is installed with the
+# package; run it from a checkout.
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import contextlib
+import multiprocessing
+from pathlib import Path
+import PIL
+from PIL import Image, ImageDraw
+import framestore
+import clean
+import convert
+
+
+_default_resolutions = ['1280x720', '1920x1080', '2560x1440']
+
+
+def _specification_sets(size):
+    # Sets of specifications that exercise the different ways frames are
+    # checked: size rules only need the header, rules near the top only
+    # decode a few rows, and rules counted from the bottom decode the whole
+    # frame.
+    width, height = size
+    size_rule = {
+        'type': 'size',
+        'name': 'size',
+        'width': width,
+        'height': height,
+    }
+    return {
+        'size': [
+            {
+                'name': 'size',
+                'rules': [
+                    size_rule,
+                ]
+            },
+        ],
+        'top': [
+            {
+                'name': 'top',
+                'rules': [
+                    {
+                        'type': 'pixel_colour',
+                        'name': 'title bar',
+                        'x': 10,
+                        'y': 10,
+                        'colour': '#2d2d2d'
+                    },
+                    {
+                        'type': 'pixel_not_colour',
+                        'name': 'not blank',
+                        'x': 100,
+                        'y': 20,
+                        'colour': '#000000'
+                    },
+                ]
+            },
+        ],
+        'bottom': [
+            {
+                'name': 'bottom',
+                'rules': [
+                    {
+                        'type': 'pixel_colour',
+                        'name': 'status bar',
+                        'x': 10,
+                        'y': -10,
+                        'colour': '#007acc'
+                    },
+                ]
+            },
+        ],
+        'mixed': [
+            {
+                'name': 'editor',
+                'rules': [
+                    size_rule,
+                    {
+                        'type': 'or',
+                        'name': 'either theme',
+                        'rules': [
+                            {
+                                'type': 'pixel_colour',
+                                'name': 'dark',
+                                'x': 10,
+                                'y': 10,
+                                'colour': '#2d2d2d'
+                            },
+                            {
+                                'type': 'pixel_colour',
+                                'name': 'light',
+                                'x': 10,
+                                'y': 10,
+                                'colour': '#f3f3f3'
+                            },
+                        ]
+                    },
+                ]
+            },
+            {
+                'name': 'browser',
+                'rules': [
+                    {
+                        'type': 'pixel_colour',
+                        'name': 'toolbar',
+                        'x': 5,
+                        'y': 40,
+                        'colour': '#dee1e6'
+                    },
+                ]
+            },
+        ],
+    }
+
+
+def _parse_resolution(value):
+    try:
+        width, height = value.lower().split('x')
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%s is not a resolution like 1920x1080" % value
+        )
+
+
+def _synthetic_frame(size, rng):
+    # Something like a screenshot of an editor: flat panels and bars, with
+    # lines of noise standing in for text. Frames from the same generator
+    # differ, as consecutive screenshots would.
+    width, height = size
+    im = Image.new('RGB', size, (30, 30, 30))
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((0, 0, width, 30), fill=(45, 45, 45))
+    draw.rectangle((0, height - 22, width, height), fill=(0, 122, 204))
+    draw.rectangle((0, 30, width // 6, height - 22), fill=(37, 37, 38))
+    line_height = 18
+    for y in range(40, height - 30, line_height):
+        indent = rng.randrange(0, 8) * 16
+        length = rng.randrange(0, width // 2)
+        if length == 0:
+            continue
+        x = width // 6 + 20 + indent
+        length = min(length, width - x)
+        if length <= 0:
+            continue
+        text_height = line_height - 6
+        noise = Image.frombytes(
+            'L',
+            (length, text_height),
+            rng.getrandbits(8 * length * text_height).to_bytes(
+                length * text_height,
+                'little'
+            )
+        ).point(lambda value: 220 if value > 200 else 30)
+        colour = Image.new(
+            'RGB',
+            (length, text_height),
+            (rng.randrange(120, 256), rng.randrange(120, 256), 200)
+        )
+        im.paste(colour, (x, y), noise)
+    return im
+
+
+def _percentile(samples, percent):
+    # Nearest rank, which is fine for the number of samples taken here
+    ordered = sorted(samples)
+    rank = int(round(percent / 100 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes rather than kilobytes
+        peak //= 1024
+        children //= 1024
+    # On Linux the peak from getrusage carries over from the process that
+    # started this one, while the one in /proc starts afresh
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    return peak, children
+
+
+def _result(stage, variant, size, latencies, elapsed=None):
+    if elapsed is None:
+        elapsed = sum(latencies)
+    result = {
+        'stage': stage,
+        'variant': variant,
+        'resolution': '{0}x{1}'.format(*size),
+        'frames': len(latencies),
+        'fps': len(latencies) / elapsed if elapsed > 0 else None,
+    }
+    if latencies:
+        result['latency'] = {
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'max': max(latencies),
+        }
+    return result
+
+
+def _timed(function, *arguments):
+    start = time.perf_counter()
+    value = function(*arguments)
+    return time.perf_counter() - start, value
+
+
+def _benchmark_encode(frames, size, formats, compress_levels):
+    results = []
+    for frame_format in formats:
+        if not framestore.format_supported(frame_format):
+            continue
+        for compress_level in compress_levels:
+            latencies = []
+            total_bytes = 0
+            for im in frames:
+                elapsed, data = _timed(
+                    framestore.encode_frame,
+                    im,
+                    frame_format,
+                    compress_level
+                )
+                latencies.append(elapsed)
+                total_bytes += len(data)
+            result = _result(
+                'encode',
+                '{0}-{1}'.format(frame_format, compress_level),
+                size,
+                latencies
+            )
+            result['bytes_per_frame'] = total_bytes // len(frames)
+            results.append(result)
+    return results
+
+
+def _write_sequence(frames, directory, frame_format):
+    directory.mkdir(parents=True, exist_ok=True)
+    for index, im in enumerate(frames, 1):
+        path = directory / '{0:06d}{1}'.format(
+            index,
+            framestore.frame_suffix(frame_format)
+        )
+        path.write_bytes(framestore.encode_frame(im, frame_format, 1))
+
+
+def _benchmark_clean(directory, size):
+    results = []
+    frames = framestore.list_frames(directory)
+    for name, specifications in sorted(_specification_sets(size).items()):
+        plan = clean.compile_specifications(specifications)
+        latencies = [
+            _timed(clean._check_frame, frame, plan)[0] for frame in frames
+        ]
+        results.append(_result('clean', name, size, latencies))
+    return results
+
+
+def _benchmark_convert(directory, destination, size, frame_count, modes):
+    results = []
+    for stream in modes:
+        destination.mkdir(parents=True, exist_ok=True)
+        # Keep the progress messages out of the results
+        with contextlib.redirect_stdout(sys.stderr):
+            elapsed, (target, returncode, errors) = _timed(
+                convert._prepare_clip,
+                directory,
+                destination,
+                20,
+                stream,
+                convert._profiles['default']
+            )
+        result = _result(
+            'convert',
+            'stream' if stream else 'glob',
+            size,
+            [],
+            elapsed
+        )
+        result['frames'] = frame_count
+        result['fps'] = frame_count / elapsed if elapsed > 0 else None
+        result['returncode'] = returncode
+        if returncode != 0:
+            result['errors'] = errors
+        results.append(result)
+    return results
+
+
+_stub_ffmpeg = """#!/bin/sh
+# Reads and discards any frames piped to it, like ffmpeg would
+for argument in "$@"; do
+    if [ "$argument" = "-" ]; then
+        cat > /dev/null
+    fi
+done
+exit 0
+"""
+
+
+def _install_stub_ffmpeg(directory):
+    stub = directory / 'ffmpeg'
+    stub.write_text(_stub_ffmpeg)
+    stub.chmod(0o755)
+    os.environ['PATH'] = str(directory) + os.pathsep + os.environ['PATH']
+
+
+def _start_xvfb(size):
+    # Starts a virtual X server of the given size and waits until it accepts
+    # connections.
+    import Xlib.display
+    import Xlib.error
+    for display_number in range(90, 100):
+        if not Path('/tmp/.X{0}-lock'.format(display_number)).exists():
+            break
+    display_name = ':{0}'.format(display_number)
+    process = subprocess.Popen(
+        [
+            'Xvfb',
+            display_name,
+            '-screen',
+            '0',
+            '{0}x{1}x24'.format(*size),
+            '-nolisten',
+            'tcp',
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            return process, Xlib.display.Display(display_name)
+        except Xlib.error.DisplayError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Xvfb did not start")
+
+
+def _benchmark_grab(size, frame_count, backends):
+    # Imported here so that the other stages can run without an X server
+    import capture
+    results = []
+    process, disp = _start_xvfb(size)
+    try:
+        os.environ['DISPLAY'] = disp.get_display_name()
+        bbox = (0, 0) + size
+        for backend in backends:
+            grab = capture._get_grab_function(disp, backend)
+            if grab is None:
+                continue
+            latencies = []
+            for i in range(frame_count):
+                latencies.append(_timed(grab, bbox)[0])
+            results.append(_result('grab', backend, size, latencies))
+    finally:
+        disp.close()
+        process.terminate()
+        process.wait()
+    return results
+
+
+def _run_stage(stage, size, args, sequence):
+    # Runs in a process of its own, so that the peak memory use reported is
+    # that of this stage at this resolution alone. The peak is shared by all
+    # of the variants of the stage, and the baseline is the peak before the
+    # stage started, including any frames generated for it.
+    frames = []
+    if stage == 'encode':
+        rng = random.Random(args.seed)
+        frames = [_synthetic_frame(size, rng) for i in range(args.frames)]
+    baseline, children = _peak_rss_kb()
+    if stage == 'encode':
+        results = _benchmark_encode(
+            frames,
+            size,
+            args.formats,
+            args.compress_levels
+        )
+    elif stage == 'clean':
+        results = _benchmark_clean(sequence, size)
+    elif stage == 'convert':
+        results = _benchmark_convert(
+            sequence,
+            sequence.parent / 'clips',
+            size,
+            args.frames,
+            # The stub does not read the files that ffmpeg would glob, so
+            # reading them is only measured when streaming
+            [True] if args.stub_ffmpeg else [False, True]
+        )
+    else:
+        results = _benchmark_grab(size, args.frames, ['xlib', 'pyscreenshot'])
+    peak, children = _peak_rss_kb()
+    for result in results:
+        result['peak_rss_kb'] = {
+            'baseline': baseline,
+            'stage': peak,
+            'ffmpeg': children,
+        }
+    return results
+
+
+def _run_stage_process(stage, size, args, sequence):
+    # Spawned rather than forked, as a forked process would start with the
+    # memory use of this one
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_run_stage, (stage, size, args, sequence))
+
+
+def _environment():
+    environment = {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+    try:
+        environment['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(Path(__file__).parent),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True
+        ).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        environment['commit'] = None
+    return environment
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the capture, clean and convert hot paths on synthetic"
+            " frames."
+        )
+    )
+    parser.add_argument(
+        "-r", "--resolution",
+        dest="resolutions",
+        metavar='WxH',
+        action="append",
+        type=_parse_resolution,
+        help=(
+            "a frame size to benchmark, which can be given more than once"
+            " (default: {0})".format(", ".join(_default_resolutions))
+        )
+    )
+    parser.add_argument(
+        "-n", "--frames",
+        metavar='N',
+        dest="frames",
+        action="store",
+        default=20,
+        type=int,
+        help="the number of frames to use at each resolution (default: 20)"
+    )
+    parser.add_argument(
+        "--stage",
+        dest="stages",
+        action="append",
+        choices=['encode', 'clean', 'convert', 'grab'],
+        help=(
+            "a stage to benchmark, which can be given more than once"
+            " (default: all but grab)"
+        )
+    )
+    parser.add_argument(
+        "--format",
+        dest="formats",
+        action="append",
+        choices=framestore.frame_formats,
+        help="a frame format to encode with (default: all)"
+    )
+    parser.add_argument(
+        "--compress-level",
+        dest="compress_levels",
+        metavar='L',
+        action="append",
+        type=int,
+        help="a compression level to encode with (default: 1 and 6)"
+    )
+    parser.add_argument(
+        "--stub-ffmpeg",
+        action="store_true",
+        dest="stub_ffmpeg",
+        help=(
+            "replace ffmpeg with a stub that discards its input, to measure"
+            " the cost of reading and decoding frames on their own"
+        )
+    )
+    parser.add_argument(
+        "--seed",
+        metavar='S',
+        dest="seed",
+        action="store",
+        default=0,
+        type=int,
+        help="the seed for generating frames (default: 0)"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar='FILE',
+        dest="output",
+        action="store",
+        help="write the results to a file instead of standard output"
+    )
+    args = parser.parse_args()
+    if args.resolutions is None:
+        args.resolutions = [
+            _parse_resolution(value) for value in _default_resolutions
+        ]
+    if args.stages is None:
+        args.stages = ['encode', 'clean', 'convert']
+    if args.formats is None:
+        args.formats = framestore.frame_formats
+    if args.compress_levels is None:
+        args.compress_levels = [1, 6]
+    return args
+
+
+def _main():
+    args = _parse_arguments()
+    report = {
+        'environment': _environment(),
+        'arguments': {
+            'frames': args.frames,
+            'seed': args.seed,
+            'stub_ffmpeg': args.stub_ffmpeg,
+        },
+        'results': [],
+        'skipped': [],
+    }
+    results = report['results']
+    work_directory = Path(tempfile.mkdtemp(prefix='timelapse-benchmark-'))
+    try:
+        if args.stub_ffmpeg:
+            _install_stub_ffmpeg(work_directory)
+            if 'convert' in args.stages:
+                report['skipped'].append(
+                    "convert glob: the ffmpeg stub does not read the frames"
+                )
+        elif 'convert' in args.stages and shutil.which('ffmpeg') is None:
+            report['skipped'].append("convert: ffmpeg was not found")
+            args.stages.remove('convert')
+        if 'grab' in args.stages and shutil.which('Xvfb') is None:
+            report['skipped'].append("grab: Xvfb was not found")
+            args.stages.remove('grab')
+        for size in args.resolutions:
+            print(
+                "Benchmarking {0}x{1}...".format(*size),
+                file=sys.stderr
+            )
+            sequence = work_directory / '{0}x{1}'.format(*size)
+            if 'clean' in args.stages or 'convert' in args.stages:
+                rng = random.Random(args.seed)
+                _write_sequence(
+                    [_synthetic_frame(size, rng) for i in range(args.frames)],
+                    sequence,
+                    'png'
+                )
+            for stage in ['encode', 'clean', 'convert', 'grab']:
+                if stage in args.stages:
+                    results += _run_stage_process(stage, size, args, sequence)
+    finally:
+        shutil.rmtree(str(work_directory), ignore_errors=True)
+
+    output = json.dumps(report, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        Path(args.output).write_text(output + '\n')
+
+
+if __name__ == "__main__":
+    _main()
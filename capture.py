@@ -1,11 +1,22 @@
 import sys
 import Xlib.display
+import Xlib.error
+from Xlib import X, Xatom
 import time
 from pathlib import Path
 import os
 import math
+import queue
+import threading
+import subprocess
+import json
+import functools
 #from os import path
 import pyscreenshot as ImageGrab
+from PIL import Image, ImageChops
+from clean import load_specifications, compile_specifications, check_image
+import framestore
+import metrics
 
 
 _debug = False
@@ -20,42 +31,112 @@ def _verify_destination(destination):
             raise NotADirectoryError()
 
 
-def _determine_initial_index(destination):
-    p = Path(destination)
+# The next frame and session numbers are kept in a small state file, so that
+# a capture can start without listing a destination that may hold many
+# thousands of frames. The directory is only scanned if the state file is
+# missing or is found to be out of date.
+_state_name = '.timelapse-state.json'
+
+
+def _load_state(directory):
+    try:
+        with (Path(directory) / _state_name).open() as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(state, dict):
+        return {}
+    return state
+
+
+def _save_state(directory, state):
+    temp_path = Path(directory) / (_state_name + '.tmp')
+    with temp_path.open('w') as state_file:
+        json.dump(state, state_file)
+    os.replace(str(temp_path), str(Path(directory) / _state_name))
+
+
+def _stored_index(state, key):
+    index = state.get(key)
+    if isinstance(index, int) and index > 0:
+        return index
+    return None
+
+
+def _scan_initial_index(destination):
     index_found = 0
-    for f in p.iterdir():
-        if f.is_file():
-            if int(f.stem) > index_found:
-                index_found = int(f.stem)
+    with os.scandir(str(destination)) as entries:
+        for entry in entries:
+            path = Path(entry.name)
+            if framestore.is_frame_file(path) and entry.is_file():
+                index_found = max(index_found, int(path.stem))
+    if framestore.is_packed(destination):
+        for entry in framestore.read_entries(destination):
+            index_found = max(index_found, entry.index)
     return index_found + 1
 
 
+def _determine_initial_index(destination):
+    p = Path(destination)
+    index = _stored_index(_load_state(p), 'next_frame')
+    if index is not None:
+        # Check that nothing has been added since the state was saved
+        stale = any(
+            (p / '{0:06d}{1}'.format(index, suffix)).exists()
+            for suffix in framestore.frame_suffixes
+        )
+        if not stale and framestore.is_packed(p):
+            last = framestore.last_entry(p)
+            stale = last is not None and last.index >= index
+        if not stale:
+            return index
+    return _scan_initial_index(p)
+
+
 def _determine_subdirectory_index(destination):
     p = Path(destination)
+    index = _stored_index(_load_state(p), 'next_session')
+    if index is not None and not (p / '{0:02}'.format(index)).exists():
+        return index
     index_found = 0
-    for f in p.iterdir():
-        if f.is_dir():
-            if int(f.stem) > index_found:
-                index_found = int(f.stem)
+    with os.scandir(str(p)) as entries:
+        for entry in entries:
+            if entry.name.isdigit() and entry.is_dir():
+                index_found = max(index_found, int(entry.name))
     return index_found + 1
 
 
-def _get_active_target_window(disp, windows):
-    focus = disp.get_input_focus()
-    if focus.focus != 0 and focus.focus != 1:
-        for w in windows:
-            if w.lower() in str(focus.focus.get_wm_name()).lower():
-                return focus.focus
-            elif callable(getattr(
-                focus.focus.query_tree()._data['parent'],
-                'get_wm_name',
-                None
-            )):
-                if w.lower() in str(
-                    focus.focus.query_tree()._data['parent'].get_wm_name()
-                ).lower():
-                    return focus.focus.query_tree()._data['parent']
-    return None
+# How many frame numbers are reserved each time the state file is written
+_reserved_frames = 100
+
+
+class _FrameIndex:
+    # Hands out frame numbers. Rather than saving the state file for every
+    # frame, a block of numbers is reserved by saving the number after the
+    # block, so the capture loop only writes it once per block. The exact
+    # next number is saved on close. If capturing stops without closing,
+    # the rest of the block is skipped next time rather than reused.
+
+    def __init__(self, directory, start):
+        self._directory = directory
+        self._state = _load_state(directory)
+        self._next = start
+        self._reserved = start
+
+    def take(self):
+        index = self._next
+        if index >= self._reserved:
+            self._reserved = index + _reserved_frames
+            self._save(self._reserved)
+        self._next += 1
+        return index
+
+    def close(self):
+        self._save(self._next)
+
+    def _save(self, next_frame):
+        self._state['next_frame'] = next_frame
+        _save_state(self._directory, self._state)
 
 
 def _get_true_active_target_window(disp, windows):
@@ -67,31 +148,834 @@ def _get_true_active_target_window(disp, windows):
     return None
 
 
-def _capture_screenshot(window, destination, index):
+class _WindowTracker:
+    # Keeps track of the focused window, whether it matches one of the target
+    # titles, and where it is on screen. Events are selected on the windows
+    # involved so that the server only needs to be queried again when
+    # something has actually changed. The focus has to be queried on every
+    # tick while it is not on a real window, as there is nothing to watch.
+
+    def __init__(self, disp, windows):
+        self._disp = disp
+        self._windows = windows
+        self._root = disp.screen().root
+        self._active_window_atom = disp.intern_atom('_NET_ACTIVE_WINDOW')
+        self._title_atoms = (Xatom.WM_NAME, disp.intern_atom('_NET_WM_NAME'))
+        self._root.change_attributes(event_mask=X.PropertyChangeMask)
+        self._focus = None
+        self._focus_parent = None
+        self._watched = []
+        self._focus_valid = False
+        self._target = None
+        self._target_valid = False
+        self._title = None
+        self._bbox = None
+
+    def target(self):
+        self._process_events()
+        try:
+            if not self._focus_valid:
+                self._update_focus()
+            if not self._target_valid:
+                self._target = self._find_target()
+                self._target_valid = True
+                self._bbox = None
+        except Xlib.error.XError:
+            # The window went away between the event and the query
+            self._reset()
+        return self._target
+
+    def title(self):
+        return self._title
+
+    def bbox(self):
+        if self._target is None:
+            return None
+        if self._bbox is None:
+            try:
+                geom = self._target.get_geometry()
+                # The parent geometry is the one that tells us the actual
+                # position on screen - the window geometry is the window
+                # interior relative to the parent.
+                pgeom = self._target.query_tree().parent.get_geometry()
+            except Xlib.error.XError:
+                self._reset()
+                return None
+            self._bbox = (
+                pgeom.x + geom.x,
+                pgeom.y + geom.y,
+                pgeom.x + geom.x + geom.width,
+                pgeom.y + geom.y + geom.height
+            )
+        return self._bbox
+
+    def _process_events(self):
+        while self._disp.pending_events():
+            event = self._disp.next_event()
+            if event.type in (
+                X.FocusIn,
+                X.FocusOut,
+                X.DestroyNotify,
+                X.UnmapNotify,
+                X.ReparentNotify
+            ):
+                self._focus_valid = False
+            elif event.type == X.PropertyNotify:
+                if event.window == self._root:
+                    if event.atom == self._active_window_atom:
+                        self._focus_valid = False
+                elif event.atom in self._title_atoms:
+                    self._target_valid = False
+            elif event.type == X.ConfigureNotify:
+                self._bbox = None
+
+    def _reset(self):
+        self._watch([])
+        self._focus = None
+        self._focus_parent = None
+        self._focus_valid = False
+        self._target = None
+        self._target_valid = False
+        self._title = None
+        self._bbox = None
+
+    def _base_mask(self, window):
+        # Without a reparenting window manager, the parent of the focus is
+        # the root, which must keep reporting changes of the active window
+        if window == self._root:
+            return X.PropertyChangeMask
+        return X.NoEventMask
+
+    def _watch(self, windows_and_masks):
+        for window in self._watched:
+            window.change_attributes(
+                event_mask=self._base_mask(window),
+                onerror=Xlib.error.CatchError()
+            )
+        self._watched = []
+        for window, mask in windows_and_masks:
+            window.change_attributes(
+                event_mask=mask | self._base_mask(window),
+                onerror=Xlib.error.CatchError()
+            )
+            self._watched.append(window)
+        self._disp.flush()
+
+    def _update_focus(self):
+        focus = self._disp.get_input_focus().focus
+        if focus in (X.NONE, X.PointerRoot) or focus == self._root:
+            if self._focus is not None:
+                self._reset()
+            return
+        if focus != self._focus:
+            self._focus = focus
+            self._focus_parent = focus.query_tree().parent
+            watched = [
+                (
+                    focus,
+                    X.FocusChangeMask
+                    | X.PropertyChangeMask
+                    | X.StructureNotifyMask
+                )
+            ]
+            # The parent is given as 0 rather than a window when there is
+            # nothing above the focus, so it can only be watched if it exists
+            parent = self._focus_parent
+            if callable(getattr(parent, 'change_attributes', None)):
+                watched.append((
+                    parent,
+                    X.PropertyChangeMask | X.StructureNotifyMask
+                ))
+            self._watch(watched)
+            self._target_valid = False
+        self._focus_valid = True
+
+    def _find_target(self):
+        self._title = None
+        if self._focus is None:
+            return None
+        focus_name = str(self._focus.get_wm_name())
+        parent_name = None
+        for w in self._windows:
+            if w.lower() in focus_name.lower():
+                self._title = focus_name
+                return self._focus
+            elif callable(getattr(self._focus_parent, 'get_wm_name', None)):
+                if parent_name is None:
+                    parent_name = str(self._focus_parent.get_wm_name())
+                if w.lower() in parent_name.lower():
+                    self._title = parent_name
+                    return self._focus_parent
+        return None
+
+
+class _WindowFinder:
+    # Finds every visible window whose title matches one of the target
+    # titles, whether it has the focus or not, for capturing several windows
+    # at once. Windows are looked at from the top of the stacking order
+    # where the window manager provides it, so if more than one window
+    # matches a title it is normally the one on top that is captured.
+
+    def __init__(self, disp, windows):
+        self._disp = disp
+        self._windows = [w.lower() for w in windows]
+        self._root = disp.screen().root
+        self._client_list_atoms = [
+            disp.intern_atom('_NET_CLIENT_LIST_STACKING'),
+            disp.intern_atom('_NET_CLIENT_LIST'),
+        ]
+
+    def targets(self):
+        # Returns the index of the title, the bounding box and the full
+        # title of each window found
+        found = {}
+        screen = self._disp.screen()
+        for window in self._clients():
+            if len(found) == len(self._windows):
+                break
+            try:
+                if window.get_attributes().map_state != X.IsViewable:
+                    continue
+                title = str(window.get_wm_name())
+                matches = [
+                    i for i, w in enumerate(self._windows)
+                    if i not in found and w in title.lower()
+                ]
+                if not matches:
+                    continue
+                geom = window.get_geometry()
+                origin = self._root.translate_coords(window, 0, 0)
+            except Xlib.error.XError:
+                # The window went away while it was being looked at
+                continue
+            bbox = _clip_to_screen(screen, (
+                origin.x,
+                origin.y,
+                origin.x + geom.width,
+                origin.y + geom.height
+            ))
+            if bbox is None:
+                continue
+            for i in matches:
+                found[i] = (i, bbox, title)
+        return [found[i] for i in sorted(found)]
+
+    def _clients(self):
+        for atom in self._client_list_atoms:
+            clients = self._root.get_full_property(atom, Xatom.WINDOW)
+            if clients is not None:
+                return [
+                    self._disp.create_resource_object('window', window_id)
+                    for window_id in reversed(clients.value)
+                ]
+        return list(reversed(self._root.query_tree().children))
+
+
+def _clip_to_screen(screen, bbox):
+    # The part of the bounding box that is on the screen, or None if there is
+    # none of it on the screen
+    clipped = (
+        max(bbox[0], 0),
+        max(bbox[1], 0),
+        min(bbox[2], screen.width_in_pixels),
+        min(bbox[3], screen.height_in_pixels)
+    )
+    if clipped[0] >= clipped[2] or clipped[1] >= clipped[3]:
+        return None
+    return clipped
+
+
+def _grab_pyscreenshot(bbox):
+    return ImageGrab.grab(bbox=bbox)
+
+
+def _xlib_grab_supported(disp):
+    # The direct grab only understands the common little-endian 32 bits per
+    # pixel layout used for 24 and 32 bit depths.
+    screen = disp.screen()
+    if screen.root_depth not in (24, 32):
+        return False
+    if disp.display.info.image_byte_order != X.LSBFirst:
+        return False
+    for pixmap_format in disp.display.info.pixmap_formats:
+        if pixmap_format.depth == screen.root_depth:
+            return pixmap_format.bits_per_pixel == 32
+    return False
+
+
+def _grab_xlib(disp, bbox):
+    screen = disp.screen()
+    # Requests extending outside of the root window fail with BadMatch.
+    clipped = _clip_to_screen(screen, bbox)
+    if clipped is None:
+        return None
+    x1, y1, x2, y2 = clipped
+    raw = screen.root.get_image(
+        x1, y1, x2 - x1, y2 - y1,
+        X.ZPixmap,
+        0xffffffff
+    )
+    # The reply is in the server's BGRX order, which Pillow cannot map
+    # directly, so it is unpacked into a new RGB image in a single pass.
+    return Image.frombuffer(
+        'RGB',
+        (x2 - x1, y2 - y1),
+        raw.data,
+        'raw',
+        'BGRX',
+        0,
+        1
+    )
+
+
+def _get_grab_function(disp, backend):
+    if backend == 'pyscreenshot':
+        return _grab_pyscreenshot
+    if not _xlib_grab_supported(disp):
+        if backend == 'xlib':
+            return None
+        if _debug:
+            print(
+                "The display pixel format is not supported by the xlib"
+                " backend, falling back to pyscreenshot"
+            )
+        return _grab_pyscreenshot
+    if backend == 'xlib':
+        def grab_or_report(bbox):
+            try:
+                return _grab_xlib(disp, bbox)
+            except Xlib.error.XError as error:
+                print (
+                    "Warning: The screenshot could not be grabbed"
+                    " ({0})".format(error)
+                )
+                return None
+        return grab_or_report
+
+    def grab(bbox):
+        try:
+            return _grab_xlib(disp, bbox)
+        except Xlib.error.XError as error:
+            if _debug:
+                print(
+                    "Direct grab failed ({0}), falling back to"
+                    " pyscreenshot".format(error)
+                )
+            return _grab_pyscreenshot(bbox)
+    return grab
+
+
+def _capture_screenshot(bbox, grab):
     capture_start = time.monotonic()
-    geom = window.get_geometry()
-    # The parent geometry is the one that tells us the actual position on
-    # screen - the window geometry is the window interior relative to the parent.
-    parent = window.query_tree()._data['parent']
-    pgeom = parent.get_geometry()
-
-    im = ImageGrab.grab(
-        bbox=(
-            pgeom.x + geom.x,
-            pgeom.y + geom.y,
-            pgeom.x + geom.x + geom.width,
-            pgeom.y + geom.y + geom.height
-        )
+    captured = time.time()
+    im = grab(bbox)
+    elapsed = time.monotonic() - capture_start
+    if im is None:
+        return None, elapsed
+    im.info['captured'] = captured
+    im.info['grab'] = elapsed
+    return im, elapsed
+
+
+def _write_frame(
+    im,
+    path,
+    frame_format='png',
+    compress_level=6,
+    png_strategy='filtered'
+):
+    encode_start = time.monotonic()
+    data = framestore.encode_frame(
+        im,
+        frame_format,
+        compress_level,
+        png_strategy
     )
-    im.save(str(destination / '{0:06d}.png'.format(index)))
-    return time.monotonic() - capture_start
+    write_start = time.monotonic()
+    with open(str(path), 'wb') as frame_file:
+        frame_file.write(data)
+    return (
+        write_start - encode_start,
+        time.monotonic() - write_start,
+        len(data)
+    )
+
+
+class _PackSink:
+    # Appends each frame to the pack of the session directory instead of
+    # writing a file for it. The frame is named by its index within the pack.
+
+    def __init__(
+        self,
+        directory,
+        frame_format='png',
+        compress_level=6,
+        png_strategy='filtered'
+    ):
+        self._writer = framestore.PackWriter(directory)
+        self._frame_format = frame_format
+        self._compress_level = compress_level
+        self._png_strategy = png_strategy
+
+    def write(self, im, path):
+        encode_start = time.monotonic()
+        data = framestore.encode_frame(
+            im,
+            self._frame_format,
+            self._compress_level,
+            self._png_strategy
+        )
+        write_start = time.monotonic()
+        self._writer.append(
+            int(path.stem),
+            data,
+            im.info.get('captured', time.time()),
+            im.width,
+            im.height,
+            self._frame_format
+        )
+        return (
+            write_start - encode_start,
+            time.monotonic() - write_start,
+            len(data)
+        )
+
+    def close(self):
+        self._writer.close()
+
+
+class _SegmentEncoder:
+    # Keeps an ffmpeg process open and pipes each frame to it as raw video,
+    # so that a session is recorded straight into video segments of a fixed
+    # length instead of a PNG per frame. ffmpeg needs a fixed frame size, so
+    # when the window size changes either a new process is started, which
+    # begins a new segment, or the frame is scaled to the current size.
+
+    def __init__(self, directory, framerate, segment_time, extension, resize):
+        self._directory = directory
+        self._framerate = framerate
+        self._segment_time = segment_time
+        self._extension = extension
+        self._resize = resize
+        self._process = None
+        self._size = None
+
+    def write(self, im, path):
+        encode_start = time.monotonic()
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        if im.size != self._size:
+            if self._process is None or self._resize == 'restart':
+                self.close()
+                self._start(im.size)
+            else:
+                im = im.resize(self._size, Image.BILINEAR)
+        data = im.tobytes()
+        write_start = time.monotonic()
+        self._process.stdin.write(data)
+        return (
+            write_start - encode_start,
+            time.monotonic() - write_start,
+            len(data)
+        )
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._process.wait()
+            self._process = None
+            self._size = None
+
+    def _next_segment_number(self):
+        segment_number = 0
+        for f in self._directory.iterdir():
+            if f.suffix == self._extension and f.stem.isdigit():
+                segment_number = max(segment_number, int(f.stem) + 1)
+        return segment_number
+
+    def _start(self, size):
+        self._size = size
+        self._process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-loglevel", "error",
+                "-f", "rawvideo",
+                "-pix_fmt", "rgb24",
+                "-s", "{0}x{1}".format(*size),
+                "-framerate", "{0:d}".format(self._framerate),
+                "-i", "-",
+                "-c:v", "libx264",
+                "-profile:v", "high",
+                "-crf", "20",
+                "-pix_fmt", "yuv420p",
+                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-force_key_frames",
+                "expr:gte(t,n_forced*{0:d})".format(self._segment_time),
+                "-f", "segment",
+                "-segment_time", "{0:d}".format(self._segment_time),
+                "-segment_start_number",
+                "{0:d}".format(self._next_segment_number()),
+                "-reset_timestamps", "1",
+                str(self._directory / "%03d{0}".format(self._extension))
+            ],
+            stdin=subprocess.PIPE,
+            # ffmpeg is kept out of the terminal's process group so that an
+            # interrupt does not stop it before the frames still waiting to be
+            # written reach it. The segment ends when its input is closed.
+            start_new_session=True
+        )
+
+
+_resample_filters = {
+    'nearest': Image.NEAREST,
+    'box': Image.BOX,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+}
+
+
+def _parse_crop(value):
+    x, y, width, height = [int(part) for part in value.split(',')]
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        raise ValueError(value)
+    return (x, y, width, height)
+
+
+def _parse_size(value):
+    width, height = [int(part) for part in value.lower().split('x')]
+    if width <= 0 or height <= 0:
+        raise ValueError(value)
+    return (width, height)
+
+
+class _Transform:
+    # Crops a region out of each frame and scales it down to fit within a
+    # maximum size, before the frame is encoded. Frames are never scaled up.
+    # What was done is recorded in the frame info so that it can be stored
+    # with the frame, and the specifications still checked against it later.
+
+    def __init__(self, crop=None, max_size=None, resample='box'):
+        self._crop = crop
+        self._max_size = max_size
+        self._resample = _resample_filters[resample]
+
+    def __call__(self, im):
+        source = im.size
+        box = (0, 0) + source
+        if self._crop is not None:
+            x, y, width, height = self._crop
+            box = (
+                min(x, source[0]),
+                min(y, source[1]),
+                min(x + width, source[0]),
+                min(y + height, source[1])
+            )
+            # The window is smaller than the region, so keep all of it
+            if box[2] <= box[0] or box[3] <= box[1]:
+                box = (0, 0) + source
+        region = (box[2] - box[0], box[3] - box[1])
+        size = region
+        if self._max_size is not None:
+            scale = min(
+                self._max_size[0] / region[0],
+                self._max_size[1] / region[1]
+            )
+            if scale < 1:
+                size = (
+                    max(1, round(region[0] * scale)),
+                    max(1, round(region[1] * scale))
+                )
+        if region == source and size == source:
+            return im
+        info = im.info
+        if region != source:
+            im = im.crop(box)
+        if size != region:
+            im = im.resize(
+                size,
+                self._resample,
+                reducing_gap=(
+                    None if self._resample == Image.NEAREST else 2.0
+                )
+            )
+        im.info = dict(info)
+        im.info['transform'] = {
+            'source': list(source),
+            'crop': [box[0], box[1], region[0], region[1]],
+        }
+        return im
+
+
+class _FrameWriter:
+    # Encodes and writes frames on a pool of worker threads so that the
+    # capture loop only has to grab them. Pillow releases the GIL while
+    # compressing, so threads are enough to spread the encoding across cores.
+    # The sink does the actual encoding and writing, and returns how long
+    # each took and how many bytes were written. If a metadata writer is
+    # given, a record is added to it for each frame written by the default
+    # sink. If a transform is given, it is applied to each frame first.
+
+    def __init__(
+        self,
+        sink,
+        workers,
+        queue_depth,
+        backpressure,
+        metadata=None,
+        transform=None
+    ):
+        self._sink = sink
+        self._metadata = metadata
+        self._transform = transform
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._backpressure = backpressure
+        self._error = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, im, path, sink=None):
+        self._raise_error()
+        item = (
+            im,
+            path,
+            sink or self._sink,
+            self._metadata if sink is None else None,
+            time.monotonic()
+        )
+        if self._backpressure == 'block':
+            self._queue.put(item)
+        elif self._backpressure == 'drop-newest':
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._count_drop(path)
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        dropped = self._queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self._queue.task_done()
+                    self._count_drop(dropped[1])
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._raise_error()
+
+    def _count_drop(self, path):
+        with self._lock:
+            self.dropped += 1
+        metrics.count('frames_dropped')
+        if _debug:
+            print("Dropped frame {0} (write queue full)".format(path.name))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            im, path, sink, metadata, submitted = item
+            try:
+                started = time.monotonic()
+                if self._transform is not None:
+                    with metrics.timer('transform'):
+                        im = self._transform(im)
+                encode_time, write_time, size = sink(im, path)
+                metrics.observe('queue', started - submitted)
+                metrics.observe('encode', encode_time)
+                metrics.observe('write', write_time)
+                metrics.count('frames_written')
+                metrics.count('bytes_written', size)
+                if metadata is not None:
+                    metadata.append(
+                        _frame_record(im, path, size, encode_time, write_time)
+                    )
+                with self._lock:
+                    self.written += 1
+                if _debug:
+                    print(
+                        "Frame {0}: queued {1:.4f}, encode {2:.4f},"
+                        " write {3:.4f}".format(
+                            path.name,
+                            started - submitted,
+                            encode_time,
+                            write_time
+                        )
+                    )
+            except Exception as error:
+                # Keep the worker going so the queue still drains, and pass
+                # the error on to the capture loop
+                if self._error is None:
+                    self._error = error
+            finally:
+                self._queue.task_done()
+
+
+def _frame_record(im, path, size, encode_time, write_time):
+    record = {
+        'name': path.name,
+        'index': int(path.stem),
+        'time': im.info.get('captured'),
+        'title': im.info.get('title'),
+        'width': im.width,
+        'height': im.height,
+        'bytes': size,
+        'grab': im.info.get('grab'),
+        'encode': encode_time,
+        'write': write_time,
+    }
+    bbox = im.info.get('bbox')
+    if bbox is not None:
+        record['x'], record['y'] = bbox[0], bbox[1]
+    transform = im.info.get('transform')
+    if transform is not None:
+        record['transform'] = transform
+    return record
+
+
+class _Deduplicator:
+    # Frames are compared by downscaling them to a small grid of blocks, each
+    # holding the average colour of the corresponding area of the frame. A
+    # frame is a duplicate if no block differs from the last stored frame by
+    # more than the threshold.
+
+    _grid_size = (128, 128)
+
+    def __init__(self, threshold):
+        self._threshold = threshold
+        self._last_size = None
+        self._last_signature = None
+        self.duplicates = 0
+
+    def is_duplicate(self, im):
+        start = time.monotonic()
+        signature = im.resize(self._grid_size, Image.BOX).convert('L')
+        duplicate = False
+        if self._last_size == im.size:
+            difference = ImageChops.difference(signature, self._last_signature)
+            duplicate = difference.getextrema()[1] <= self._threshold
+        metrics.observe('dedup', time.monotonic() - start)
+        if duplicate:
+            self.duplicates += 1
+            metrics.count('frames_duplicate')
+        else:
+            self._last_size = im.size
+            self._last_signature = signature
+        return duplicate
+
+
+class _Validator:
+    # Checks grabbed screenshots against frame specifications, the same way
+    # the clean command does, before they are ever encoded. Rejected
+    # screenshots are discarded, or written to the rejection directory if
+    # there is one.
+
+    def __init__(self, plan, destination):
+        self._plan = plan
+        self.destination = destination
+        self.rejected = 0
+
+    def check(self, im):
+        with metrics.timer('rules'):
+            passed = check_image(im, self._plan)
+        if not passed:
+            self.rejected += 1
+            metrics.count('frames_rejected')
+        return passed
 
 
 _feedback_frames = [' ', '◔', '◑', '◕', '●', '◉']
 
+# How long to wait between looking for a window to capture when capturing
+# continuously and there is none
+_idle_poll_period = 0.01
+
+
+class _Scheduler:
+    # Captures are scheduled on a fixed grid of deadlines measured from the
+    # start, so the time taken by each capture does not push the following
+    # ones back. Deadlines that have already passed by the time a capture
+    # finishes are skipped and counted as missed. With an interval of 0
+    # there is no grid, and each capture is due as soon as the last ends.
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._start = time.monotonic()
+        self._tick = 1
+        self._last = self._start
+        self.captures = 0
+        self.missed = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def deadline(self):
+        if self._interval == 0:
+            return self._last
+        return self._start + self._tick * self._interval
+
+    def phase(self, now):
+        return now - (self.deadline() - self._interval)
+
+    def begin(self, now):
+        lateness = now - self.deadline()
+        self.captures += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        metrics.count('captures')
+        metrics.observe('lateness', max(lateness, 0.0))
+        return lateness
+
+    def advance(self, now):
+        if self._interval == 0:
+            self._last = now
+            return
+        next_tick = int((now - self._start) // self._interval) + 1
+        if next_tick > self._tick + 1:
+            self.missed += next_tick - self._tick - 1
+            metrics.count('deadlines_missed', next_tick - self._tick - 1)
+            self._tick = next_tick
+        else:
+            self._tick += 1
+
+    def sleep(self, now):
+        # Wake for the next deadline, or for the next change of the feedback
+        # spinner if that comes first.
+        if self._interval == 0:
+            return
+        step = self._interval / (len(_feedback_frames) - 1)
+        until_feedback = step - (self.phase(now) % step) + 0.001
+        time.sleep(max(min(self.deadline() - now, until_feedback), 0))
+
 
 def _display_feedback(t, interval, is_capture=False):
-    sys.stdout.write("\b" * (interval + 10))
+    sys.stdout.write("\b" * (int(math.ceil(interval)) + 10))
     if is_capture:
         sys.stdout.write(_feedback_frames[-1])
     else:
@@ -105,48 +989,294 @@ def _display_feedback(t, interval, is_capture=False):
     sys.stdout.flush()
 
 
-def _capture_timelapse(args):
+def _sequence_name(title):
+    # A directory name for the sequence of windows matching a title
+    name = ''.join(c if c.isalnum() else '-' for c in title.lower())
+    return '-'.join(part for part in name.split('-') if part) or 'window'
+
+
+class _Sequence:
+    # One image sequence being captured: the directory it is stored in, how
+    # its frames are numbered and written, and the checks made on each frame
+    # before it is stored. When several windows are captured at once, each
+    # has a sequence of its own in a named subdirectory of the destination.
+
+    def __init__(self, args, plan, name=None):
+        self.name = name
+        self._args = args
+        destination = Path(args.destination)
+        rejected_path = None
+        if args.rejected is not None:
+            rejected_path = Path(args.rejected)
+        if name is not None:
+            destination = destination / name
+            destination.mkdir(exist_ok=True)
+            if rejected_path is not None:
+                rejected_path = rejected_path / name
+        if not args.single:
+            capture_number = _determine_subdirectory_index(destination)
+            state = _load_state(destination)
+            state['next_session'] = capture_number + 1
+            _save_state(destination, state)
+            destination = destination / '{0:02}'.format(capture_number)
+            if not destination.exists():
+                destination.mkdir()
+            if rejected_path is not None:
+                rejected_path = rejected_path / destination.name
+        self.path = destination
+        self.frame_index = _FrameIndex(
+            destination,
+            _determine_initial_index(destination)
+        )
+        self.validator = None
+        if plan is not None:
+            if rejected_path is not None:
+                rejected_path.mkdir(parents=True, exist_ok=True)
+            self.validator = _Validator(plan, rejected_path)
+        self._suffix = framestore.frame_suffix(args.frame_format)
+        self._write_frame = functools.partial(
+            _write_frame,
+            frame_format=args.frame_format,
+            compress_level=args.compress_level,
+            png_strategy=args.png_strategy
+        )
+        self.encoder = None
+        sink = self._write_frame
+        workers = args.workers
+        if args.live:
+            self.encoder = _SegmentEncoder(
+                destination,
+                args.live_framerate,
+                args.segment_time,
+                '.' + args.live_format,
+                args.live_resize
+            )
+            sink = self.encoder.write
+            # Frames have to reach ffmpeg in order
+            workers = 1
+        elif args.pack:
+            self.encoder = _PackSink(
+                destination,
+                args.frame_format,
+                args.compress_level,
+                args.png_strategy
+            )
+            sink = self.encoder.write
+        self.metadata = None
+        if not args.live:
+            self.metadata = framestore.MetadataWriter(destination)
+        transform = None
+        if args.crop is not None or args.max_size is not None:
+            transform = _Transform(args.crop, args.max_size, args.resample)
+        self.writer = _FrameWriter(
+            sink,
+            workers,
+            args.queue_depth,
+            args.backpressure,
+            self.metadata,
+            transform
+        )
+        self.deduplicator = None
+        if args.dedup:
+            self.deduplicator = _Deduplicator(args.dedup_threshold)
+
+    def store(self, im):
+        if self.validator is not None and not self.validator.check(im):
+            if self._args.debug:
+                print ("Bad frame rejected")
+            if self.validator.destination is not None:
+                self.writer.submit(
+                    im,
+                    self.validator.destination / '{0:06d}{1}'.format(
+                        self.frame_index.take(),
+                        self._suffix
+                    ),
+                    self._write_frame
+                )
+        elif (
+            self.deduplicator is not None
+            and self.deduplicator.is_duplicate(im)
+        ):
+            if self._args.debug:
+                print ("Duplicate frame skipped")
+        else:
+            self.writer.submit(
+                im,
+                self.path / '{0:06d}{1}'.format(
+                    self.frame_index.take(),
+                    self._suffix
+                )
+            )
+
+    def close(self):
+        prefix = ''
+        if self.name is not None:
+            prefix = '{0}: '.format(self.name)
+        if self.writer.pending() > 0:
+            print(
+                "\n{0}Writing {1} pending frame(s)...".format(
+                    prefix,
+                    self.writer.pending()
+                )
+            )
+        try:
+            self.writer.close()
+        finally:
+            try:
+                if self.encoder is not None:
+                    self.encoder.close()
+                if self.metadata is not None:
+                    self.metadata.close()
+            finally:
+                self.frame_index.close()
+        if self.writer.dropped > 0:
+            print(
+                "{0}{1} frame(s) dropped because the write queue was"
+                " full".format(prefix, self.writer.dropped)
+            )
+        if self.deduplicator is not None:
+            print(
+                "{0}{1} frame(s) written, {2} duplicate(s) skipped".format(
+                    prefix,
+                    self.writer.written,
+                    self.deduplicator.duplicates
+                )
+            )
+        if self.validator is not None:
+            print(
+                "{0}{1} frame(s) rejected by the specifications".format(
+                    prefix,
+                    self.validator.rejected
+                )
+            )
+
+
+def _capture_timelapse(args, plan):
+    disp = Xlib.display.Display()
+    grab = _get_grab_function(disp, args.backend)
+    if grab is None:
+        print(
+            "The display pixel format is not supported by the xlib capture"
+            " backend."
+        )
+        sys.exit(1)
     sys.stdout.write("\x1b[?25l")
     sys.stdout.flush()
-    disp = Xlib.display.Display()
-    destination = args.destination
-    if not args.single:
-        capture_number = _determine_subdirectory_index(destination)
-        destination = Path(destination) / '{0:02}'.format(capture_number)
-        if not destination.exists():
-            destination.mkdir()
-    screenshot_index = _determine_initial_index(destination)
-    dest_path = Path(destination)
-    initial_time = time.monotonic()
-    while(True):
-        if time.monotonic() - initial_time >= args.interval:
-            _display_feedback(
-                time.monotonic() - initial_time,
-                args.interval,
-                True
-            )
-            initial_time = time.monotonic()
-            window = _get_active_target_window(disp, args.windows)
-            if window is not None:
-                elapsed = _capture_screenshot(
-                    window,
-                    dest_path,
-                    screenshot_index
+    sequences = []
+    try:
+        if args.each_window:
+            finder = _WindowFinder(disp, args.windows)
+            names = []
+            for title in args.windows:
+                name = _sequence_name(title)
+                if name in names:
+                    name = '{0}-{1}'.format(name, len(names) + 1)
+                names.append(name)
+                sequences.append(_Sequence(args, plan, name))
+
+            def find_targets():
+                return [
+                    (sequences[i], bbox, title)
+                    for i, bbox, title in finder.targets()
+                ]
+        else:
+            tracker = _WindowTracker(disp, args.windows)
+            sequences.append(_Sequence(args, plan))
+
+            def find_targets():
+                window = tracker.target()
+                bbox = tracker.bbox()
+                if window is None or bbox is None:
+                    return []
+                # A window entirely off the screen has nothing to grab
+                if _clip_to_screen(disp.screen(), bbox) is None:
+                    return []
+                return [(sequences[0], bbox, tracker.title())]
+
+        scheduler = _Scheduler(args.interval)
+        try:
+            _capture_loop(args, find_targets, grab, scheduler)
+        finally:
+            if scheduler.missed > 0 or _debug:
+                print(
+                    "{0} capture(s) made, {1} deadline(s) missed, average"
+                    " lateness {2:.4f}s, maximum {3:.4f}s".format(
+                        scheduler.captures,
+                        scheduler.missed,
+                        scheduler.total_lateness / max(scheduler.captures, 1),
+                        scheduler.max_lateness
+                    )
                 )
-                screenshot_index += 1
+    finally:
+        # Every sequence is closed, so that the frames waiting to be written
+        # for the others are not lost if closing one fails
+        error = None
+        for sequence in sequences:
+            try:
+                sequence.close()
+            except Exception as close_error:
+                if error is None:
+                    error = close_error
+        if error is not None:
+            raise error
+
+
+def _capture_targets(args, targets, grab):
+    # All of the windows are grabbed with a single read of the area covering
+    # them, which is then cut up into a frame for each.
+    area = (
+        min(bbox[0] for sequence, bbox, title in targets),
+        min(bbox[1] for sequence, bbox, title in targets),
+        max(bbox[2] for sequence, bbox, title in targets),
+        max(bbox[3] for sequence, bbox, title in targets),
+    )
+    im, elapsed = _capture_screenshot(area, grab)
+    if im is None:
+        return
+    metrics.observe('grab', elapsed)
+    if args.debug:
+        print ("Screenshot grab time: {0}".format(elapsed))
+    for sequence, bbox, title in targets:
+        frame = im
+        if bbox != area:
+            frame = im.crop((
+                bbox[0] - area[0],
+                bbox[1] - area[1],
+                bbox[2] - area[0],
+                bbox[3] - area[1],
+            ))
+        frame.info['title'] = title
+        frame.info['bbox'] = bbox
+        sequence.store(frame)
+    if args.interval > 0 and elapsed > args.interval:
+        print (
+            "Warning: Screenshot capture took longer than the"
+            " wait interval ({0})".format(elapsed)
+        )
+
+
+def _capture_loop(args, find_targets, grab, scheduler):
+    while(True):
+        now = time.monotonic()
+        if now >= scheduler.deadline():
+            focus_start = time.monotonic()
+            targets = find_targets()
+            focus_elapsed = time.monotonic() - focus_start
+            if targets:
+                _display_feedback(args.interval, args.interval, True)
+                lateness = scheduler.begin(now)
+                metrics.observe('focus', focus_elapsed)
                 if args.debug:
-                    print ("Screenshot time: {0}".format(elapsed))
-                if elapsed > args.interval:
-                    print (
-                        "Warning: Screenshot capture took longer than the"
-                        " wait interval ({0})".format(elapsed)
-                    )
+                    print ("Capture started {0:.4f}s late".format(lateness))
+                _capture_targets(args, targets, grab)
+            elif args.interval == 0:
+                # Nothing to capture, so wait a little before looking again
+                # rather than spinning until a window is focused
+                time.sleep(_idle_poll_period)
+            scheduler.advance(time.monotonic())
         else:
-            _display_feedback(
-                time.monotonic() - initial_time,
-                args.interval
-            )
-        time.sleep(0.001)
+            _display_feedback(scheduler.phase(now), args.interval)
+            scheduler.sleep(now)
 
 
 def capture(args):
@@ -171,8 +1301,77 @@ def capture(args):
         )
         sys.exit(1)
 
+    if args.live and args.pack:
+        print ("The --live and --pack switches cannot be used together.")
+        sys.exit(1)
+
+    if not framestore.format_supported(args.frame_format):
+        print (
+            "The installed version of Pillow cannot write %s images."
+            % args.frame_format
+        )
+        sys.exit(1)
+
+    if args.interval < 0:
+        print ("The interval cannot be negative.")
+        sys.exit(1)
+
+    if args.workers < 1:
+        print ("There must be at least one worker to write screenshots.")
+        sys.exit(1)
+
+    if args.queue_depth < 1:
+        print ("The queue depth must be at least 1.")
+        sys.exit(1)
+
+    try:
+        if args.crop is not None:
+            args.crop = _parse_crop(args.crop)
+    except ValueError:
+        print (
+            "The crop region must be given as X,Y,WIDTH,HEIGHT, with a"
+            " positive width and height."
+        )
+        sys.exit(1)
+
+    try:
+        if args.max_size is not None:
+            args.max_size = _parse_size(args.max_size)
+    except ValueError:
+        print ("The maximum size must be given as WIDTHxHEIGHT.")
+        sys.exit(1)
+
+    plan = None
+    if args.specification:
+        try:
+            plan = compile_specifications(
+                load_specifications(args.specification)
+            )
+        except FileNotFoundError as e:
+            print ("The specification file does not exist (%s)." % e.filename)
+            sys.exit(1)
+
+    try:
+        if args.rejected is not None:
+            _verify_destination(args.rejected)
+    except NotADirectoryError:
+        print ("The specified rejection directory is not a directory.")
+        sys.exit(1)
+    except FileNotFoundError:
+        print (
+            "The specified rejection directory could not be created because"
+            " of missing parents."
+        )
+        sys.exit(1)
+    except PermissionError:
+        print (
+            "The rejection directory could not be created due to inadequate"
+            " permissions."
+        )
+        sys.exit(1)
+
     try:
-        _capture_timelapse(args)
+        _capture_timelapse(args, plan)
     except IOError as error:
         print (error)
         print ("An IO error occurred while saving a screenshot to a file.")
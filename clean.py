@@ -2,7 +2,14 @@ import sys
 import os
 from PIL import Image, ImageColor
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
 import json
+import sqlite3
+import time
+import framestore
+import metrics
 
 
 _debug = False
@@ -27,6 +34,206 @@ def _verify_destination(destination):
             raise NotADirectoryError()
 
 
+class _Frame:
+    # Wraps an opened, but not yet decoded, image. The size comes from the
+    # header, so size rules never cause a decode. Pixels are only decoded
+    # when the first pixel rule is evaluated, and each one is only looked up
+    # once however many rules and specifications refer to it.
+    #
+    # PNG rows are stored in order, so if decode_rows is given only that
+    # many rows from the top of the image are decoded.
+    #
+    # Instead of an image, a function to open one can be given along with
+    # the size recorded at capture, in which case the image is not opened at
+    # all unless a pixel rule needs it. The time spent opening and decoding
+    # is kept in decode_time.
+    #
+    # If the frame was cropped or scaled down at capture, the transform
+    # recorded for it is given too. The size is then that of the window it
+    # was captured from, and pixel positions are mapped into the stored
+    # frame, so that the rules apply as if the whole window had been stored.
+
+    def __init__(
+        self,
+        image=None,
+        decode_rows=None,
+        opener=None,
+        size=None,
+        transform=None
+    ):
+        self._image = image
+        self._opener = opener
+        self._access = None
+        self._partial = False
+        self._pixels = {}
+        self.decode_time = 0.0
+        if size is None:
+            size = self._open().size
+        self._stored_size = size
+        self._transform = transform
+        self.width, self.height = size
+        if transform is not None:
+            self.width, self.height = transform['source']
+            if decode_rows is not None:
+                crop_y, crop_height = transform['crop'][1], transform['crop'][3]
+                decode_rows = int(
+                    max(0, decode_rows - crop_y) * size[1] / crop_height
+                ) + 1
+        self._decode_rows = decode_rows
+
+    def getpixel(self, xy):
+        try:
+            return self._pixels[xy]
+        except KeyError:
+            pass
+        point = xy
+        if self._transform is not None:
+            point = self._map(xy)
+        if self._access is None:
+            self._load()
+        pixel = self._access[point]
+        self._pixels[xy] = pixel
+        return pixel
+
+    def _map(self, xy):
+        x, y = xy
+        if x < 0:
+            x += self.width
+        if y < 0:
+            y += self.height
+        crop_x, crop_y, crop_width, crop_height = self._transform['crop']
+        if not (
+            crop_x <= x < crop_x + crop_width
+            and crop_y <= y < crop_y + crop_height
+        ):
+            raise IndexError("pixel is outside the stored region")
+        return (
+            int((x - crop_x) * self._stored_size[0] / crop_width),
+            int((y - crop_y) * self._stored_size[1] / crop_height)
+        )
+
+    def close(self):
+        if self._opener is not None and self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def _open(self):
+        if self._image is None:
+            start = time.monotonic()
+            self._image = self._opener()
+            self.decode_time += time.monotonic() - start
+        return self._image
+
+    def _reopen(self):
+        if self._opener is not None:
+            return self._opener()
+        return Image.open(self._image.filename)
+
+    def _load(self):
+        image = self._open()
+        start = time.monotonic()
+        self._partial = False
+        if self._decode_rows is not None:
+            self._partial = _limit_decode(image, self._decode_rows)
+        try:
+            self._access = image.load()
+        except (OSError, SyntaxError):
+            if not self._partial:
+                raise
+            # Fall back to decoding the whole image if the decoder objected
+            # to stopping early.
+            image.close()
+            self._image = self._reopen()
+            self._access = self._image.load()
+            self._partial = False
+        self.decode_time += time.monotonic() - start
+
+
+def _limit_decode(image, rows):
+    # Shrinks the area the PNG decoder fills so that it stops after the given
+    # number of rows. Only plain, non-interlaced PNGs with a single data tile
+    # are handled.
+    if image.format != 'PNG' or image.info.get('interlace'):
+        return False
+    if len(image.tile) != 1 or image.tile[0][0] != 'zip':
+        return False
+    if rows >= image.height:
+        return False
+    tile = image.tile[0]
+    extents = (0, 0, image.width, rows)
+    image.tile = [(tile[0], extents) + tuple(tile[2:])]
+    image._size = (image.width, rows)
+    return True
+
+
+# Relative cost of evaluating each type of rule. Size rules only need the
+# image header, while pixel rules need the image to be decoded.
+_rule_costs = {
+    'size': 0,
+    'pixel_colour': 1,
+    'pixel_not_colour': 1,
+}
+
+
+def _compile_rule(rule):
+    compiled = dict(rule)
+    rule_type = rule['type']
+    if rule_type == 'pixel_colour' or rule_type == 'pixel_not_colour':
+        compiled['rgb'] = ImageColor.getrgb(rule['colour'])
+    if rule_type == 'or':
+        compiled['rules'] = _order_rules(map(_compile_rule, rule['rules']))
+        compiled['cost'] = max(
+            [sub_rule['cost'] for sub_rule in compiled['rules']],
+            default=0
+        )
+    else:
+        compiled['cost'] = _rule_costs.get(rule_type, 0)
+    return compiled
+
+
+def _order_rules(rules):
+    # Cheap rules go first so that evaluation can stop before the image has
+    # to be decoded. The sort is stable, so rules of the same cost keep the
+    # order they were written in.
+    return sorted(rules, key=lambda rule: rule['cost'])
+
+
+def _pixel_rows(rule):
+    if rule['type'] == 'or':
+        rows = [_pixel_rows(sub_rule) for sub_rule in rule['rules']]
+        if None in rows:
+            return None
+        return max(rows, default=0)
+    if rule['type'] == 'pixel_colour' or rule['type'] == 'pixel_not_colour':
+        if rule['y'] < 0:
+            # Counted from the bottom, so the whole image is needed
+            return None
+        return rule['y'] + 1
+    return 0
+
+
+def compile_specifications(specifications):
+    compiled = []
+    for specification in specifications:
+        compiled_specification = dict(specification)
+        compiled_specification['rules'] = _order_rules(
+            map(_compile_rule, specification['rules'])
+        )
+        compiled.append(compiled_specification)
+    decode_rows = _pixel_rows({
+        'type': 'or',
+        'rules': [
+            rule
+            for specification in compiled
+            for rule in specification['rules']
+        ]
+    })
+    return {
+        'specifications': compiled,
+        'decode_rows': decode_rows,
+    }
+
+
 def _check_rule(frame, rule):
     rule_type = rule['type']
     if rule_type == 'size':
@@ -41,8 +248,7 @@ def _check_rule(frame, rule):
         except IndexError:
             # This occurs if the frame is smaller than expected
             return False
-        rule_color = ImageColor.getrgb(rule['colour'])
-        match = rule_color == pixel
+        match = rule['rgb'] == pixel
         if rule_type == 'pixel_colour' and not match and _debug:
             print("Colour rule broken (%s)" % rule['name'])
         if rule_type == 'pixel_not_colour' and match and _debug:
@@ -74,45 +280,215 @@ def _check_rules(frame, specification):
     return passed
 
 
-def _process_frame(frame_path, destination, delete_immediately, specifications):
+def _init_worker(debug):
+    global _debug
+    _debug = debug
+
+
+def _check_specifications(frame, plan):
+    return any(
+        map(
+            lambda spec: _check_rules(frame, spec),
+            plan['specifications']
+        )
+    )
+
+
+def check_image(image, plan):
+    return _check_specifications(_Frame(image), plan)
+
+
+def _check_frame(frame, plan):
+    # Returns how long decoding and evaluating the rules took along with the
+    # result, as the metrics of a worker process would otherwise be lost.
     passed = None
-    with Image.open(frame_path) as frame:
-        passed = any(
-            map(
-                lambda spec: _check_rules(frame, spec),
-                specifications
-            )
+    start = time.monotonic()
+    checked_frame = _Frame(
+        decode_rows=plan['decode_rows'],
+        opener=frame.open,
+        size=frame.dimensions,
+        transform=frame.transform
+    )
+    try:
+        passed = _check_specifications(checked_frame, plan)
+    finally:
+        checked_frame.close()
+    elapsed = time.monotonic() - start
+    if not passed and _debug:
+        print('Bad frame detected (%s)' % frame)
+    decode_time = checked_frame.decode_time
+    return passed, decode_time, elapsed - decode_time
+
+
+# Bump this when a change to the rules would change the result for frames
+# that have already been checked.
+_cache_version = 1
+
+
+class _ResultCache:
+    # Remembers the result of checking each frame against a particular set of
+    # specifications, so frames that have not changed since they were last
+    # checked can be skipped. Frames are identified by their directory, name,
+    # size and modification time. The cache lives in the user cache directory
+    # rather than beside the frames, so that it does not turn up in the image
+    # sequences themselves.
+
+    def __init__(self, path, plan):
+        self._plan_hash = hashlib.sha1(
+            json.dumps(
+                [_cache_version, plan],
+                sort_keys=True
+            ).encode('utf-8')
+        ).hexdigest()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(path))
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " directory TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " plan TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime INTEGER NOT NULL,"
+            " passed INTEGER NOT NULL,"
+            " PRIMARY KEY (directory, name, plan)"
+            ")"
         )
-    if not passed:
+
+    def lookup(self, directory):
+        cursor = self._connection.execute(
+            "SELECT name, size, mtime, passed FROM results"
+            " WHERE directory = ? AND plan = ?",
+            (str(directory.resolve()), self._plan_hash)
+        )
+        return {
+            name: (size, mtime, bool(passed))
+            for name, size, mtime, passed in cursor
+        }
+
+    def store(self, directory, results):
+        directory = str(directory.resolve())
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results"
+                " (directory, name, plan, size, mtime, passed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        directory,
+                        name,
+                        self._plan_hash,
+                        size,
+                        mtime,
+                        int(passed)
+                    )
+                    for name, size, mtime, passed in results
+                ]
+            )
+
+    def forget(self, directory, names):
+        directory = str(directory.resolve())
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM results WHERE directory = ? AND name = ?",
+                [(directory, name) for name in names]
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+def _get_cache_path():
+    try:
+        xdg_cache = Path(os.environ['XDG_CACHE_HOME'])
+    except KeyError:
+        xdg_cache = Path('~/.cache').expanduser()
+    return xdg_cache / 'timelapse' / 'clean.sqlite'
+
+
+def _open_cache(plan):
+    try:
+        return _ResultCache(_get_cache_path(), plan)
+    except (OSError, sqlite3.Error) as error:
         if _debug:
-            print('Bad frame detected (%s)' % frame_path)
-        if not _test:
-            if delete_immediately:
-                frame_path.unlink()
-            else:
-                frame_path.rename(Path(destination) / frame_path.name)
+            print("The results cache could not be opened (%s)" % error)
+        return None
 
-    return passed
+
+def _reject_frames(frames, destination, delete_immediately):
+    if not _test:
+        framestore.reject_frames(frames, destination, delete_immediately)
 
 
 def _process_ultimate_source(
     source,
     destination,
     delete_immediately,
-    specifications,
+    plan,
     rejected,
-    processed
+    processed,
+    executor,
+    jobs,
+    cache
 ):
-    for frame in Path(source).iterdir():
-        if frame.is_file():
-            processed += 1
-            if not _process_frame(
-                frame,
-                destination,
-                delete_immediately,
-                specifications
-            ):
-                rejected.append(frame)
+    frames = [
+        (frame, frame.size, frame.mtime)
+        for frame in framestore.list_frames(source)
+    ]
+
+    cached = {}
+    if cache is not None:
+        cached = cache.lookup(Path(source))
+    results = {}
+    unchecked = []
+    for frame, size, mtime in frames:
+        entry = cached.get(frame.name)
+        if entry is not None and entry[0] == size and entry[1] == mtime:
+            results[frame.name] = entry[2]
+        else:
+            unchecked.append(frame)
+    if _debug and cache is not None:
+        print(
+            "%d frame(s) in %s already checked" % (len(results), source)
+        )
+
+    check = functools.partial(_check_frame, plan=plan)
+    if executor is None:
+        checked = map(check, unchecked)
+    else:
+        # Results come back in the same order as the frames, so the outcome
+        # is the same as checking them one at a time.
+        chunksize = max(1, min(64, len(unchecked) // (jobs * 4)))
+        checked = executor.map(check, unchecked, chunksize=chunksize)
+    for frame, (passed, decode_time, rules_time) in zip(unchecked, checked):
+        results[frame.name] = passed
+        metrics.observe('decode', decode_time)
+        metrics.observe('rules', rules_time)
+        metrics.count('frames_checked')
+    metrics.count('frames_cached', len(frames) - len(unchecked))
+
+    removed = []
+    rejected_here = []
+    for frame, size, mtime in frames:
+        processed += 1
+        if not results[frame.name]:
+            rejected_here.append(frame)
+            metrics.count('frames_rejected')
+            if not _test:
+                removed.append(frame.name)
+    _reject_frames(rejected_here, destination, delete_immediately)
+    rejected += rejected_here
+
+    if cache is not None:
+        removed_names = set(removed)
+        cache.store(
+            Path(source),
+            [
+                (frame.name, size, mtime, results[frame.name])
+                for frame, size, mtime in frames
+                if frame.name not in removed_names
+            ]
+        )
+        cache.forget(Path(source), removed)
     return processed, rejected
 
 
@@ -121,53 +497,83 @@ def _process_source(
     single,
     destination,
     delete_immediately,
-    specifications
+    plan,
+    jobs,
+    cache
 ):
     rejected = []
     processed = 0
-    processed, rejected = _process_ultimate_source(
-        source,
-        destination,
-        delete_immediately,
-        specifications,
-        rejected,
-        processed
-    )
-    if not single:
-        for child in Path(source).iterdir():
-            if child.is_dir():
-                child_destination = Path(destination) / child.name
-                if not delete_immediately:
-                    child_destination.mkdir(exist_ok=True)
-                processed, rejected = _process_ultimate_source(
-                    child,
-                    child_destination,
-                    delete_immediately,
-                    specifications,
-                    rejected,
-                    processed
-                )
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(_debug,)
+        )
+    try:
+        processed, rejected = _process_ultimate_source(
+            source,
+            destination,
+            delete_immediately,
+            plan,
+            rejected,
+            processed,
+            executor,
+            jobs,
+            cache
+        )
+        if not single:
+            for child in Path(source).iterdir():
+                if child.is_dir():
+                    child_destination = Path(destination) / child.name
+                    if not delete_immediately:
+                        child_destination.mkdir(exist_ok=True)
+                    processed, rejected = _process_ultimate_source(
+                        child,
+                        child_destination,
+                        delete_immediately,
+                        plan,
+                        rejected,
+                        processed,
+                        executor,
+                        jobs,
+                        cache
+                    )
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     return processed, rejected
 
 
-def _get_spec_path(spec):
-    spec_path = Path(spec)
-    if spec_path.exists():
-        return spec_path
+def get_config_path():
     try:
         xdg_config = Path(os.environ['XDG_CONFIG_HOME'])
     except KeyError:
         xdg_config = Path('~/.config').expanduser()
-    spec_path = xdg_config / 'timelapse' / 'framespecs' / '{}.json'.format(spec)
-    return spec_path
+    return xdg_config / 'timelapse'
+
+
+def _get_spec_path(spec):
+    spec_path = Path(spec)
+    if spec_path.exists():
+        return spec_path
+    return get_config_path() / 'framespecs' / '{}.json'.format(spec)
+
+
+def load_specifications(specifications):
+    parsed_specifications = []
+    for spec in specifications:
+        spec_path = _get_spec_path(spec)
+        with spec_path.open() as spec_file:
+            parsed_specifications.append(json.load(spec_file))
+    return parsed_specifications
 
 
 def clean(args):
     global _debug, _test
     _debug = args.debug
     _test = args.test
-    parsed_specifications = []
 
     try:
         _verify_source(args.source)
@@ -198,10 +604,7 @@ def clean(args):
         sys.exit(1)
 
     try:
-        for spec in args.specification:
-            spec_path = _get_spec_path(spec)
-            with spec_path.open() as spec_file:
-                parsed_specifications.append(json.load(spec_file))
+        parsed_specifications = load_specifications(args.specification)
     except FileNotFoundError as e:
         print ("The specification file does not exist (%s)." % e.filename)
         sys.exit(1)
@@ -213,13 +616,23 @@ def clean(args):
         for spec in parsed_specifications:
             print(spec)
 
-    processed, rejected = _process_source(
-        args.source,
-        args.single,
-        args.destination,
-        args.delete_immediately,
-        parsed_specifications
-    )
+    plan = compile_specifications(parsed_specifications)
+    cache = None
+    if not args.no_cache:
+        cache = _open_cache(plan)
+    try:
+        processed, rejected = _process_source(
+            args.source,
+            args.single,
+            args.destination,
+            args.delete_immediately,
+            plan,
+            args.jobs or os.cpu_count() or 1,
+            cache
+        )
+    finally:
+        if cache is not None:
+            cache.close()
 
     if processed == 0:
         print("No image sequences were found.")
@@ -5,7 +5,17 @@ import os
 from os import path
 import subprocess
 import tempfile
-from shutil import copyfile
+import queue
+import threading
+import functools
+import hashlib
+import json
+import statistics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+import framestore
+import metrics
+from clean import get_config_path
 
 
 _debug = False
@@ -32,15 +42,18 @@ def _verify_source(destination):
 def _prepare_clips(args):
     source = Path(args.source)
     dest = Path(args.destination)
+    profile = _get_profile(args.profile)
+    if args.jobs > 1 and 'threads' not in profile:
+        # Split the available cores between the concurrent ffmpeg processes
+        profile['threads'] = max(1, (os.cpu_count() or 1) // args.jobs)
 
-    last_sequence_directory = None
+    sequence_directories = []
     if not args.single:
         for child in sorted(source.glob('*')):
             if child.is_dir():
                 if not child.samefile(dest):
-                    last_sequence_directory = child
-                    _prepare_clip(child, dest, args.framerate)
-        if not last_sequence_directory:
+                    sequence_directories.append(child)
+        if not sequence_directories:
             print(
                 "No image sequences were found."
                 " Did you mean to use the --single switch?"
@@ -48,92 +61,718 @@ def _prepare_clips(args):
             sys.exit(1)
     else:
         if not source.samefile(dest):
-            last_sequence_directory = source
-            _prepare_clip(source, dest, args.framerate)
+            sequence_directories.append(source)
 
-    if last_sequence_directory and not args.skip_pad_clip:
+    manifest = {}
+    if not args.force:
+        manifest = _load_manifest(dest)
+    tasks = []
+    fingerprints = {}
+    frame_counts = {}
+    clips = []
+    # The number of threads does not change the output, so it is left out of
+    # the fingerprint.
+    settings = {
+        key: value for key, value in profile.items() if key != 'threads'
+    }
+
+    def add_task(target, frames, parameters, task, frame_count=None):
+        clips.append(target)
+        fingerprint = _fingerprint(frames, parameters)
+        entry = manifest.get(target.name)
+        if target.exists() and entry == fingerprint:
+            print("Skipping {0}, which is unchanged".format(target))
+            metrics.count('clips_skipped')
+            return
+        fingerprints[target.name] = fingerprint
+        frame_counts[target.name] = frame_count or len(frames)
+        tasks.append((target, task))
+
+    # A session can be left without any frames if capturing was stopped
+    # before the window was focused, and there is nothing to encode for it
+    sequence_frames = []
+    for seq_directory in sequence_directories:
+        frames = framestore.list_frames(seq_directory)
+        if frames:
+            sequence_frames.append((seq_directory, frames))
+        else:
+            print("Skipping {0}, which has no frames".format(seq_directory))
+    sequence_directories = [
+        seq_directory for seq_directory, frames in sequence_frames
+    ]
+
+    for seq_directory, frames in sequence_frames:
+        pad = (
+            args.inline_pad
+            and not args.skip_pad_clip
+            and seq_directory == sequence_directories[-1]
+        )
+        # ffmpeg cannot read frames out of a pack, repeat frames to match
+        # their timestamps, or read a mix of image formats with one pattern,
+        # so in those cases the frames are streamed to it
+        stream = (
+            args.stream
+            or args.timestamps
+            or framestore.is_packed(seq_directory)
+            or len(set(Path(frame.name).suffix for frame in frames)) > 1
+        )
+        add_task(
+            _clip_target(seq_directory, dest),
+            frames,
+            [
+                args.framerate,
+                stream,
+                args.timestamps,
+                _encoding_arguments(settings, pad)
+            ],
+            functools.partial(
+                _prepare_clip,
+                seq_directory,
+                dest,
+                args.framerate,
+                stream,
+                profile,
+                pad,
+                args.timestamps
+            )
+        )
+
+    if (
+        sequence_directories
+        and not args.skip_pad_clip
+        and not args.inline_pad
+    ):
         # Prepare a padding clip
-        _prepare_padding_clip(last_sequence_directory, dest)
+        last_sequence_directory, last_frames = sequence_frames[-1]
+        add_task(
+            _padding_target(last_sequence_directory, dest),
+            last_frames[-1:],
+            ["loop", args.framerate, _encoding_arguments(settings)],
+            functools.partial(
+                _prepare_padding_clip,
+                last_sequence_directory,
+                dest,
+                args.framerate,
+                profile
+            ),
+            _padding_seconds * args.framerate
+        )
 
+    finished = _run_tasks(tasks, args.jobs)
+    if finished:
+        for target, elapsed in finished:
+            manifest[target.name] = fingerprints[target.name]
+        _save_manifest(dest, manifest)
+        _report_encoding(args.profile, finished, frame_counts)
 
-def _prepare_clip(seq_directory, dest, framerate):
-    target = dest.joinpath("{0}.mp4".format(seq_directory.name))
-    if target.exists():
-        target.unlink()
+    if args.join:
+        _join_clips(clips, dest.joinpath(args.join_name), args.jobs, profile)
+
+
+def _report_encoding(profile_name, finished, frame_counts):
+    print("Encoding report (profile {0}):".format(profile_name))
+    total_frames = 0
+    total_elapsed = 0.0
+    total_size = 0
+    for target, elapsed in finished:
+        frames = frame_counts[target.name]
+        size = target.stat().st_size
+        print(
+            "  {0}: {1} frame(s) in {2:.1f}s ({3:.1f} fps), {4:.1f} MB".format(
+                target.name,
+                frames,
+                elapsed,
+                frames / max(elapsed, 0.001),
+                size / 1000000
+            )
+        )
+        total_frames += frames
+        total_elapsed += elapsed
+        total_size += size
     print(
-        "Preparing clip for {0} - destination {1}".format(seq_directory, target)
+        "  Total: {0} frame(s) in {1:.1f}s of encoding ({2:.1f} fps),"
+        " {3:.1f} MB".format(
+            total_frames,
+            total_elapsed,
+            total_frames / max(total_elapsed, 0.001),
+            total_size / 1000000
+        )
+    )
+
+
+# Encoding profiles. Settings left out of a profile in the configuration
+# file are taken from the default profile.
+_profiles = {
+    'default': {
+        'codec': 'libx264',
+        'profile': 'high',
+        'crf': 20,
+        'pix_fmt': 'yuv420p',
+    },
+    'draft': {
+        'codec': 'libx264',
+        'profile': 'high',
+        'preset': 'ultrafast',
+        'tune': 'stillimage',
+        'crf': 28,
+        'pix_fmt': 'yuv420p',
+    },
+    'archive': {
+        'codec': 'libx264',
+        'profile': 'high',
+        'preset': 'veryslow',
+        'tune': 'stillimage',
+        'crf': 14,
+        'pix_fmt': 'yuv420p',
+    },
+}
+
+
+def _load_profiles():
+    profiles = dict(_profiles)
+    profiles_path = get_config_path() / 'profiles.json'
+    if profiles_path.exists():
+        with profiles_path.open() as profiles_file:
+            loaded = json.load(profiles_file)
+        if not isinstance(loaded, dict):
+            raise ValueError("the file must contain an object of profiles")
+        for name, settings in loaded.items():
+            if not isinstance(settings, dict):
+                raise ValueError("profile %s must be an object" % name)
+            for key, value in settings.items():
+                if not isinstance(value, (str, int, float, type(None))):
+                    raise ValueError(
+                        "setting %s of profile %s must be a string or number"
+                        % (key, name)
+                    )
+            if not isinstance(settings.get('codec', ''), str):
+                raise ValueError(
+                    "the codec of profile %s must be a string" % name
+                )
+            profile = dict(_profiles['default'])
+            profile.update(settings)
+            profiles[name] = profile
+    return profiles
+
+
+def _get_profile(name):
+    return dict(_load_profiles()[name])
+
+
+def _clip_target(seq_directory, dest):
+    return dest.joinpath("{0}.mp4".format(seq_directory.name))
+
+
+def _padding_target(seq_directory, dest):
+    return dest.joinpath("{0}_pad.mp4".format(seq_directory.name))
+
+
+_manifest_name = "manifest.json"
+
+
+def _load_manifest(dest):
+    # The manifest records what each clip in the destination was made from,
+    # so that clips can be skipped if their frames and encoding parameters
+    # have not changed since.
+    try:
+        with dest.joinpath(_manifest_name).open() as manifest_file:
+            return json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_manifest(dest, manifest):
+    temp_path = dest.joinpath(_manifest_name + ".tmp")
+    with temp_path.open('w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    os.replace(str(temp_path), str(dest.joinpath(_manifest_name)))
+
+
+def _fingerprint(frames, parameters):
+    fingerprint = hashlib.sha1(
+        json.dumps(parameters, default=str).encode('utf-8')
     )
-    # The capture_output argument did not work here... Output is just being
-    # printed, and stderr will probably be empty in the event of an error??
+    for frame in frames:
+        fingerprint.update(
+            "{0}\0{1:d}\0{2:d}\n".format(
+                frame.name,
+                frame.size,
+                frame.mtime
+            ).encode('utf-8')
+        )
+    return fingerprint.hexdigest()
+
+
+def _probe_clip(clip):
+    # The stream properties that have to match for clips to be joined
+    # without re-encoding.
     status = subprocess.run(
         [
-            "ffmpeg",
-            "-framerate",
-            "{0:d}".format(framerate),
-            "-pattern_type",
-            "glob",
-            "-i",
-            "{0}/*.png".format(seq_directory),
-            "-c:v",
-            "libx264",
-            "-profile:v",
-            "high",
-            "-crf",
-            "20",
-            "-pix_fmt",
-            "yuv420p",
-            "-vf",
-            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
-            target
-        ]
+            "ffprobe",
+            "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries",
+            "stream=codec_name,profile,width,height,pix_fmt,r_frame_rate,"
+            "time_base",
+            "-of", "json",
+            str(clip)
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
     )
     if status.returncode != 0:
-        print (status.stderr)
+        return None
+    streams = json.loads(status.stdout.decode('utf-8')).get('streams', [])
+    if not streams:
+        return None
+    stream = streams[0]
+    return tuple(
+        stream.get(key)
+        for key in (
+            'codec_name',
+            'profile',
+            'width',
+            'height',
+            'pix_fmt',
+            'r_frame_rate',
+            'time_base'
+        )
+    )
 
 
-def _prepare_padding_clip(seq_directory, dest):
-    target = dest.joinpath("{0}_pad.mp4".format(seq_directory.name))
-    if target.exists():
-        target.unlink()
-    # Get the last frame of the sequence
-    last_frame = sorted(seq_directory.glob('*.png'))[-1]
+def _conform_clip(clip, target, properties, profile):
+    # Re-encodes a clip to match the properties of the others, so that it
+    # can be joined to them by copying.
+    width, height = properties[2:4]
+    frame_rate, time_base = properties[5:7]
+    print("Re-encoding {0} to match the other clips".format(clip))
+    video_filter = (
+        "scale={0}:{1}:force_original_aspect_ratio=decrease,"
+        "pad={0}:{1}:(ow-iw)/2:(oh-ih)/2,fps={2}".format(
+            width,
+            height,
+            frame_rate
+        )
+    )
+    returncode, errors = _run_ffmpeg(
+        ["-i", str(clip)]
+        + _encoding_arguments(profile, video_filter=video_filter)
+        + [
+            "-video_track_timescale", time_base.split('/')[-1],
+            str(target)
+        ]
+    )
+    return target, returncode, errors
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for i in range(60):
-            copyfile(
-                str(last_frame),
-                str(Path(temp_dir).joinpath("{0:02d}.png".format(i)))
+
+def _join_clips(clips, output, jobs, profile):
+    if not clips:
+        print("No clips to join")
+        return
+    missing = [clip for clip in clips if not clip.exists()]
+    if missing:
+        print(
+            "Not joining the clips, as {0} could not be prepared".format(
+                ", ".join(str(clip) for clip in missing)
+            )
+        )
+        return
+    try:
+        properties = [_probe_clip(clip) for clip in clips]
+    except FileNotFoundError:
+        print("ffprobe is required to join the clips.")
+        return
+    if None in properties:
+        print(
+            "Not joining the clips, as {0} could not be read".format(
+                clips[properties.index(None)]
             )
+        )
+        return
+    # The most common set of properties is kept, and only the clips that
+    # differ from it are re-encoded. Ties go to the earliest clip.
+    common = max(
+        properties,
+        key=lambda p: (properties.count(p), -properties.index(p))
+    )
+
+    if output.exists():
+        output.unlink()
+    with tempfile.TemporaryDirectory(dir=str(output.parent)) as temp_dir:
+        parts = []
+        tasks = []
+        for index, clip in enumerate(clips):
+            if properties[index] == common:
+                parts.append(clip)
+            else:
+                part = Path(temp_dir).joinpath("{0:04d}.mp4".format(index))
+                parts.append(part)
+                tasks.append(
+                    (
+                        part,
+                        functools.partial(
+                            _conform_clip,
+                            clip,
+                            part,
+                            common,
+                            profile
+                        )
+                    )
+                )
+        if len(_run_tasks(tasks, jobs)) != len(tasks):
+            print("Not joining the clips, as some could not be re-encoded")
+            return
 
+        concat_list = Path(temp_dir).joinpath("clips.txt")
+        with concat_list.open('w') as list_file:
+            for part in parts:
+                list_file.write(
+                    "file '{0}'\n".format(
+                        str(part.resolve()).replace("'", "'\\''")
+                    )
+                )
         print(
-            "Preparing pad clip from {0} - destination: {1}".format(
-                seq_directory,
-                target
+            "Joining {0} clip(s) - destination {1}".format(len(parts), output)
+        )
+        returncode, errors = _run_ffmpeg(
+            [
+                "-f", "concat",
+                "-safe", "0",
+                "-i", str(concat_list),
+                "-c", "copy",
+                str(output)
+            ]
+        )
+        if returncode != 0:
+            print(
+                "ffmpeg failed with status {0} while joining:".format(
+                    returncode
+                )
             )
+            print(errors)
+
+
+def _run_tasks(tasks, jobs):
+    # Each task is a target and a function that makes it. A task that fails
+    # with an exception is reported like any other failure, so that the
+    # other clips still get made.
+    failures = []
+    finished = []
+
+    def timed(target, task):
+        start = time.monotonic()
+        try:
+            result = task()
+        except Exception as error:
+            if target.exists():
+                target.unlink()
+            result = (target, None, str(error) or type(error).__name__)
+        return result, time.monotonic() - start
+
+    def report(number, timed_result):
+        result, elapsed = timed_result
+        target, returncode, errors = result
+        if returncode == 0:
+            print("[{0}/{1}] Finished {2}".format(number, len(tasks), target))
+            finished.append((target, elapsed))
+            metrics.count('clips_encoded')
+        else:
+            print("[{0}/{1}] Failed {2}".format(number, len(tasks), target))
+            failures.append(result)
+            metrics.count('clips_failed')
+        metrics.observe('clip', elapsed)
+
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(timed, target, task) for target, task in tasks
+            ]
+            for number, future in enumerate(as_completed(futures), 1):
+                report(number, future.result())
+    else:
+        for number, (target, task) in enumerate(tasks, 1):
+            report(number, timed(target, task))
+
+    for target, returncode, errors in failures:
+        if returncode is None and errors:
+            print("{0} could not be prepared: {1}".format(target, errors))
+        elif returncode is None:
+            print("No frames were found for {0}".format(target))
+        else:
+            print(
+                "ffmpeg failed with status {0} for {1}:".format(
+                    returncode,
+                    target
+                )
+            )
+            print(errors)
+    if failures:
+        print("{0} clip(s) could not be prepared".format(len(failures)))
+    return finished
+
+
+_padding_seconds = 60
+
+
+def _encoding_arguments(profile, pad=False, video_filter=None):
+    if video_filter is None:
+        video_filter = "pad=ceil(iw/2)*2:ceil(ih/2)*2"
+    if pad:
+        # Hold the last frame at the end of the clip
+        video_filter += ",tpad=stop_mode=clone:stop_duration={0:d}".format(
+            _padding_seconds
         )
-        # The capture_output argument did not work here... Output is just being
-        # printed, and stderr will probably be empty in the event of an error??
-        status = subprocess.run(
+    arguments = ["-c:v", profile['codec']]
+    for key, option in (
+        ('profile', '-profile:v'),
+        ('preset', '-preset'),
+        ('tune', '-tune'),
+        ('crf', '-crf'),
+        ('pix_fmt', '-pix_fmt'),
+        ('threads', '-threads'),
+    ):
+        if profile.get(key) is not None:
+            arguments += [option, str(profile[key])]
+    arguments += ["-vf", video_filter]
+    return arguments
+
+
+_ffmpeg = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error"]
+
+
+def _run_ffmpeg(arguments, frames=None):
+    # stderr goes to a temporary file rather than a pipe, so that ffmpeg can
+    # never block on a full pipe while frames are being written to it.
+    with tempfile.TemporaryFile() as log, metrics.timer('ffmpeg'):
+        if frames is None:
+            returncode = subprocess.run(
+                _ffmpeg + ["-nostdin"] + arguments,
+                stderr=log
+            ).returncode
+        else:
+            returncode = _stream_frames(arguments, frames, log)
+        log.seek(0)
+        return returncode, log.read().decode('utf-8', 'replace')
+
+
+def _read_frames(frames, repeats=None):
+    for i, frame in enumerate(frames):
+        if repeats is not None and repeats[i] == 0:
+            continue
+        start = time.monotonic()
+        try:
+            with frame.open() as image:
+                image = image.convert('RGB')
+        except (OSError, ValueError, SyntaxError) as error:
+            raise OSError(
+                "frame {0} could not be read ({1})".format(frame, error)
+            ) from error
+        metrics.observe('decode', time.monotonic() - start)
+        metrics.count('frames_read')
+        for repeat in range(1 if repeats is None else repeats[i]):
+            yield image
+
+
+def _frame_repeats(frames):
+    # Works out how many times each frame has to be shown so that the clip
+    # follows the times the frames were captured at, rather than showing
+    # each for the same length of time. The usual gap between frames is
+    # taken to be one frame of the clip, so any longer gaps, such as where
+    # duplicates were skipped, hold the frame before them for longer.
+    timestamps = [frame.timestamp for frame in frames]
+    if len(timestamps) < 2 or None in timestamps:
+        return None
+    interval = statistics.median(
+        [later - earlier for earlier, later in zip(timestamps, timestamps[1:])]
+    )
+    if interval <= 0:
+        return None
+    positions = [
+        round((timestamp - timestamps[0]) / interval)
+        for timestamp in timestamps
+    ]
+    positions.append(positions[-1] + 1)
+    return [
+        max(0, later - earlier)
+        for earlier, later in zip(positions, positions[1:])
+    ]
+
+
+def _read_ahead(frames, depth):
+    # Reads and decodes frames on a separate thread, so that ffmpeg can be
+    # encoding one frame while the next ones are being read.
+    frame_queue = queue.Queue(maxsize=depth)
+    finished = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            for frame in frames:
+                put(frame)
+                if stop.is_set():
+                    return
+        except Exception as error:
+            put(error)
+        put(finished)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _stream_frames(arguments, frames, log):
+    # Feeds raw frames to ffmpeg through its standard input. ffmpeg needs the
+    # frame size up front, so any frames of a different size are scaled to
+    # the size of the first, as ffmpeg does when reading an image sequence.
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return None
+    size = first.size
+    process = subprocess.Popen(
+        _ffmpeg + [
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-s", "{0}x{1}".format(*size),
+        ] + arguments,
+        stdin=subprocess.PIPE,
+        stderr=log
+    )
+    try:
+        frame = first
+        while frame is not None:
+            if frame.size != size:
+                frame = frame.resize(size, Image.BILINEAR)
+            process.stdin.write(frame.tobytes())
+            frame = next(frames, None)
+    except BrokenPipeError:
+        # ffmpeg has stopped reading, so its exit status will say why
+        pass
+    finally:
+        # ffmpeg is always waited for, even if a frame could not be read
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+    return returncode
+
+
+def _prepare_clip(
+    seq_directory,
+    dest,
+    framerate,
+    stream=False,
+    profile=None,
+    pad=False,
+    timestamps=False
+):
+    target = _clip_target(seq_directory, dest)
+    if target.exists():
+        target.unlink()
+    print(
+        "Preparing clip for {0} - destination {1}".format(seq_directory, target)
+    )
+    encoding = _encoding_arguments(profile or _profiles['default'], pad)
+    encoding += [target]
+    if stream:
+        frames = framestore.list_frames(seq_directory)
+        repeats = None
+        if timestamps:
+            repeats = _frame_repeats(frames)
+            if repeats is None:
+                print(
+                    "Capture times are not recorded for all of the frames in"
+                    " {0}, so they will be shown at a fixed rate".format(
+                        seq_directory
+                    )
+                )
+        try:
+            returncode, errors = _run_ffmpeg(
+                ["-framerate", "{0:d}".format(framerate), "-i", "-"]
+                + encoding,
+                _read_ahead(_read_frames(frames, repeats), 8)
+            )
+        except OSError as error:
+            # Whatever ffmpeg wrote before the error is incomplete
+            if target.exists():
+                target.unlink()
+            return target, None, str(error)
+    else:
+        # Every frame is in the same format, so the first gives the pattern
+        frames = framestore.list_frames(seq_directory)
+        suffix = Path(frames[0].name).suffix if frames else '.png'
+        returncode, errors = _run_ffmpeg(
             [
-                "ffmpeg",
                 "-framerate",
+                "{0:d}".format(framerate),
+                "-pattern_type",
+                "glob",
+                "-i",
+                "{0}/*{1}".format(seq_directory, suffix),
+            ] + encoding
+        )
+    return target, returncode, errors
+
+
+def _prepare_padding_clip(seq_directory, dest, framerate, profile=None):
+    target = _padding_target(seq_directory, dest)
+    if target.exists():
+        target.unlink()
+    # Get the last frame of the sequence
+    frames = framestore.list_frames(seq_directory)
+    if not frames:
+        return target, None, ''
+    last_frame = frames[-1]
+
+    print(
+        "Preparing pad clip from {0} - destination: {1}".format(
+            seq_directory,
+            target
+        )
+    )
+    # ffmpeg needs the frame as a file, so a packed frame is extracted to a
+    # temporary one
+    with tempfile.TemporaryDirectory(dir=str(dest)) as temp_directory:
+        if isinstance(last_frame, framestore.PackedFrame):
+            frame_path = Path(temp_directory) / last_frame.name
+            frame_path.write_bytes(last_frame.read_bytes())
+        else:
+            frame_path = last_frame.path
+        # The single frame is looped for the length of the clip, at the same
+        # framerate as the other clips so that joining them can copy it
+        returncode, errors = _run_ffmpeg(
+            [
+                "-loop",
                 "1",
-                "-pattern_type", "glob", "-i", "{0}/*.png".format(temp_dir),
-                "-c:v",
-                "libx264",
-                "-profile:v",
-                "high",
-                "-crf",
-                "20",
-                "-pix_fmt",
-                "yuv420p",
-                "-vf",
-                "pad=ceil(iw/2)*2:ceil(ih/2)*2",
-                target
+                "-framerate",
+                "{0:d}".format(framerate),
+                "-t",
+                "{0:d}".format(_padding_seconds),
+                "-i",
+                str(frame_path),
             ]
+            + _encoding_arguments(profile or _profiles['default'])
+            + [target]
         )
-        if status.returncode != 0:
-            print (status.stderr)
+    return target, returncode, errors
 
 
 def convert(args):
@@ -167,6 +806,18 @@ def convert(args):
         )
         sys.exit(1)
 
+    try:
+        profiles = _load_profiles()
+    except ValueError as e:
+        print ("The encoding profiles file could not be read (%s)." % e)
+        sys.exit(1)
+    if args.profile not in profiles:
+        print (
+            "The encoding profile does not exist (%s). Available profiles: %s"
+            % (args.profile, ", ".join(sorted(profiles)))
+        )
+        sys.exit(1)
+
     try:
         _prepare_clips(args)
     except IOError:
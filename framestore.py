@@ -0,0 +1,720 @@
+import sys
+import os
+import io
+import json
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from pathlib import Path
+from PIL import Image, features
+
+
+_debug = False
+
+# A session can be stored as a pack instead of an image file per frame. The
+# pack file holds the encoded frames one after another, each preceded by a
+# small header, and is only ever appended to. The index file holds a fixed
+# size entry for each frame, so any frame can be found without reading the
+# pack. If the index is lost or left incomplete, it can be rebuilt from the
+# record headers in the pack.
+pack_name = 'frames.pack'
+index_name = 'frames.idx'
+# Capture also records what it knows about each frame in a sidecar file, one
+# JSON object per line, so that the frames themselves do not have to be
+# opened to find out their size or when they were captured.
+metadata_name = 'frames.jsonl'
+
+_pack_magic = b'TLFRAMES'
+_pack_version = 1
+_pack_header = struct.Struct('<8sH')
+# index, length, timestamp, width, height, format
+_record_header = struct.Struct('<IIdII4s')
+# index, offset, length, timestamp, width, height, format, flags
+_index_entry = struct.Struct('<IQIdII4sB')
+
+_flag_deleted = 1
+
+# The image formats that frames may be stored in. The name of each is also
+# the file extension, and the format recorded for it in a pack.
+frame_formats = ['png', 'webp', 'bmp', 'tiff']
+frame_suffixes = ['.' + frame_format for frame_format in frame_formats]
+
+# The zlib strategies that PNG frames may be compressed with. Pillow passes
+# the strategy to zlib as the compression type, and uses filtered by default.
+# Run length and Huffman only encoding are much quicker, and screenshots with
+# large flat areas compress well with either.
+png_strategies = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'rle': zlib.Z_RLE,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+}
+
+IndexEntry = namedtuple(
+    'IndexEntry',
+    [
+        'position',
+        'index',
+        'offset',
+        'length',
+        'timestamp',
+        'width',
+        'height',
+        'format',
+        'flags',
+    ]
+)
+
+
+def frame_suffix(frame_format):
+    return '.' + frame_format
+
+
+def format_supported(frame_format):
+    if frame_format == 'webp':
+        return features.check('webp')
+    return True
+
+
+def encode_frame(
+    im,
+    frame_format='png',
+    compress_level=6,
+    png_strategy='filtered'
+):
+    # All of the formats are lossless. The compression level trades encoding
+    # time for size: for PNG it is the zlib level, for WebP it sets the
+    # encoder effort, and for TIFF any level above 0 enables run length
+    # encoding. BMP frames are always stored uncompressed. The PNG strategy
+    # is ignored for the other formats.
+    buffer = io.BytesIO()
+    if frame_format == 'png':
+        im.save(
+            buffer,
+            format='PNG',
+            compress_level=compress_level,
+            compress_type=png_strategies[png_strategy]
+        )
+    elif frame_format == 'webp':
+        im.save(
+            buffer,
+            format='WEBP',
+            lossless=True,
+            quality=compress_level * 100 // 9,
+            method=compress_level * 6 // 9
+        )
+    elif frame_format == 'bmp':
+        im.save(buffer, format='BMP')
+    elif frame_format == 'tiff':
+        im.save(
+            buffer,
+            format='TIFF',
+            compression='packbits' if compress_level > 0 else None
+        )
+    else:
+        raise ValueError("Unknown frame format %s" % frame_format)
+    return buffer.getvalue()
+
+
+def is_frame_file(path):
+    return path.suffix.lower() in frame_suffixes and path.stem.isdigit()
+
+
+def is_packed(directory):
+    return (Path(directory) / pack_name).exists()
+
+
+def _pack_format(name):
+    return name.encode('ascii')[:4].ljust(4, b'\0')
+
+
+def _unpack_format(value):
+    return value.rstrip(b'\0').decode('ascii')
+
+
+def _scan_pack(pack_file, offset, position):
+    # Reads the record headers in the pack from the given offset, producing
+    # index entries for them. A record cut short at the end of the file is
+    # ignored.
+    entries = []
+    pack_file.seek(0, os.SEEK_END)
+    end = pack_file.tell()
+    while offset + _record_header.size <= end:
+        pack_file.seek(offset)
+        header = pack_file.read(_record_header.size)
+        index, length, timestamp, width, height, frame_format = (
+            _record_header.unpack(header)
+        )
+        data_offset = offset + _record_header.size
+        if data_offset + length > end:
+            break
+        entries.append(
+            IndexEntry(
+                position,
+                index,
+                data_offset,
+                length,
+                timestamp,
+                width,
+                height,
+                _unpack_format(frame_format),
+                0
+            )
+        )
+        position += 1
+        offset = data_offset + length
+    return entries
+
+
+def _read_index(directory):
+    entries = []
+    index_path = Path(directory) / index_name
+    try:
+        data = index_path.read_bytes()
+    except FileNotFoundError:
+        data = b''
+    # Any partial entry at the end is ignored
+    count = len(data) // _index_entry.size
+    for position in range(count):
+        values = _index_entry.unpack_from(data, position * _index_entry.size)
+        entries.append(
+            IndexEntry(
+                position,
+                values[0],
+                values[1],
+                values[2],
+                values[3],
+                values[4],
+                values[5],
+                _unpack_format(values[6]),
+                values[7]
+            )
+        )
+    return entries
+
+
+def _within_pack(pack_file, entries):
+    # Drops the entries for any frames past the end of the pack, which can
+    # be left in the index if the end of the pack was lost but the index was
+    # not. Frames after the first one lost cannot be in the pack either.
+    pack_file.seek(0, os.SEEK_END)
+    end = pack_file.tell()
+    for position, entry in enumerate(entries):
+        if entry.offset + entry.length > end:
+            return entries[:position]
+    return entries
+
+
+def _pack_end(entries):
+    if not entries:
+        return _pack_header.size
+    last = entries[-1]
+    return last.offset + last.length
+
+
+def _encode_index_entry(entry):
+    return _index_entry.pack(
+        entry.index,
+        entry.offset,
+        entry.length,
+        entry.timestamp,
+        entry.width,
+        entry.height,
+        _pack_format(entry.format),
+        entry.flags
+    )
+
+
+class PackWriter:
+    # Appends frames to the pack in a session directory, creating it if
+    # necessary. Appending is safe from several threads.
+
+    def __init__(self, directory):
+        directory = Path(directory)
+        self._lock = threading.Lock()
+        pack_path = directory / pack_name
+        index_path = directory / index_name
+        if not pack_path.exists():
+            with pack_path.open('wb') as pack_file:
+                pack_file.write(_pack_header.pack(_pack_magic, _pack_version))
+            index_path.write_bytes(b'')
+        self._pack_file = pack_path.open('r+b')
+        _check_header(self._pack_file)
+        # Repair the index if a previous session stopped part way through
+        # writing a frame, or it has been lost.
+        self._index_file = _open_index(index_path)
+        self.entries = _repair_index(
+            self._pack_file,
+            self._index_file,
+            _read_index(directory)
+        )
+        self._index_file.seek(0, os.SEEK_END)
+        self._offset = _pack_end(self.entries)
+        self._pack_file.truncate(self._offset)
+
+    def append(self, index, data, timestamp, width, height, frame_format):
+        with self._lock:
+            self._pack_file.seek(self._offset)
+            self._pack_file.write(
+                _record_header.pack(
+                    index,
+                    len(data),
+                    timestamp,
+                    width,
+                    height,
+                    _pack_format(frame_format)
+                )
+            )
+            self._pack_file.write(data)
+            self._pack_file.flush()
+            entry = IndexEntry(
+                len(self.entries),
+                index,
+                self._offset + _record_header.size,
+                len(data),
+                timestamp,
+                width,
+                height,
+                frame_format,
+                0
+            )
+            self._index_file.write(_encode_index_entry(entry))
+            self._index_file.flush()
+            self.entries.append(entry)
+            self._offset = entry.offset + entry.length
+
+    def close(self):
+        with self._lock:
+            self._pack_file.close()
+            self._index_file.close()
+
+
+def _open_index(index_path):
+    index_path.touch()
+    return index_path.open('r+b')
+
+
+def _repair_index(pack_file, index_file, entries):
+    # Adds entries to the index for any frames at the end of the pack that it
+    # is missing, dropping a partial entry at its end and any entries for
+    # frames past the end of the pack, and returns all of the entries.
+    entries = _within_pack(pack_file, entries)
+    missing = _scan_pack(pack_file, _pack_end(entries), len(entries))
+    index_file.truncate(len(entries) * _index_entry.size)
+    index_file.seek(0, os.SEEK_END)
+    for entry in missing:
+        index_file.write(_encode_index_entry(entry))
+    index_file.flush()
+    return entries + missing
+
+
+def _check_header(pack_file):
+    pack_file.seek(0)
+    header = pack_file.read(_pack_header.size)
+    if len(header) < _pack_header.size:
+        raise ValueError("The frame pack is truncated")
+    magic, version = _pack_header.unpack(header)
+    if magic != _pack_magic:
+        raise ValueError("Not a frame pack")
+    if version > _pack_version:
+        raise ValueError("Unsupported frame pack version %d" % version)
+
+
+def read_entries(directory):
+    # Reads the index of a pack, including any frames at the end of the pack
+    # that the index is missing.
+    with (Path(directory) / pack_name).open('rb') as pack_file:
+        _check_header(pack_file)
+        entries = _within_pack(pack_file, _read_index(directory))
+        entries += _scan_pack(pack_file, _pack_end(entries), len(entries))
+    return entries
+
+
+def last_entry(directory):
+    # The most recently appended frame in a pack, found without reading the
+    # whole index.
+    directory = Path(directory)
+    entries = []
+    try:
+        with (directory / index_name).open('rb') as index_file:
+            index_file.seek(0, os.SEEK_END)
+            count = index_file.tell() // _index_entry.size
+            if count > 0:
+                index_file.seek((count - 1) * _index_entry.size)
+                values = _index_entry.unpack(
+                    index_file.read(_index_entry.size)
+                )
+                entries.append(
+                    IndexEntry(
+                        count - 1,
+                        values[0],
+                        values[1],
+                        values[2],
+                        values[3],
+                        values[4],
+                        values[5],
+                        _unpack_format(values[6]),
+                        values[7]
+                    )
+                )
+    except FileNotFoundError:
+        pass
+    with (directory / pack_name).open('rb') as pack_file:
+        _check_header(pack_file)
+        if entries and not _within_pack(pack_file, entries):
+            # The end of the pack has been lost, so the last frame left in it
+            # has to be found from the whole index
+            entries = _within_pack(pack_file, _read_index(directory))[-1:]
+        position = entries[-1].position + 1 if entries else 0
+        entries += _scan_pack(pack_file, _pack_end(entries), position)
+    if not entries:
+        return None
+    return entries[-1]
+
+
+def read_frame_data(directory, entry):
+    with (Path(directory) / pack_name).open('rb') as pack_file:
+        pack_file.seek(entry.offset)
+        return pack_file.read(entry.length)
+
+
+def mark_deleted(directory, entries):
+    # Frames cannot be removed from the pack, so they are flagged in the
+    # index instead and skipped by readers. The frames may only have been
+    # found by scanning the pack, so the index is repaired first, once for
+    # all of the frames given.
+    directory = Path(directory)
+    with (directory / pack_name).open('rb') as pack_file, \
+            _open_index(directory / index_name) as index_file:
+        _check_header(pack_file)
+        indexed = _repair_index(pack_file, index_file, _read_index(directory))
+        for entry in entries:
+            if (
+                entry.position >= len(indexed)
+                or indexed[entry.position].offset != entry.offset
+            ):
+                raise ValueError("The frame pack has changed")
+        for entry in sorted(entries, key=lambda entry: entry.position):
+            index_file.seek(entry.position * _index_entry.size)
+            index_file.write(_encode_index_entry(entry._replace(
+                flags=entry.flags | _flag_deleted
+            )))
+
+
+class MetadataWriter:
+    # Appends a record for each frame to the sidecar file of a session.
+
+    def __init__(self, directory):
+        self._lock = threading.Lock()
+        self._file = (Path(directory) / metadata_name).open(
+            'a',
+            encoding='utf-8'
+        )
+
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_metadata(directory):
+    # The records in the sidecar file of a session, by frame name. Later
+    # records replace earlier ones for the same frame, and a line left
+    # incomplete by an interrupted capture is ignored.
+    metadata = {}
+    try:
+        metadata_file = (Path(directory) / metadata_name).open(
+            encoding='utf-8'
+        )
+    except FileNotFoundError:
+        return metadata
+    with metadata_file:
+        for line in metadata_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and 'name' in record:
+                metadata[record['name']] = record
+    return metadata
+
+
+class FileFrame:
+    # A frame stored as an image file of its own. The dimensions, capture
+    # time and any transform applied at capture come from the sidecar, and
+    # are None if it has no record of the frame or the file has changed
+    # since it was recorded.
+
+    def __init__(self, path, stat=None, record=None):
+        self.path = path
+        self.name = path.name
+        if stat is None:
+            stat = path.stat()
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.dimensions = None
+        self.timestamp = None
+        self.transform = None
+        if record is not None and record.get('bytes') == self.size:
+            if 'width' in record and 'height' in record:
+                self.dimensions = (record['width'], record['height'])
+            self.timestamp = record.get('time')
+            self.transform = record.get('transform')
+
+    def __str__(self):
+        return str(self.path)
+
+    def open(self):
+        return Image.open(self.path)
+
+    def read_bytes(self):
+        return self.path.read_bytes()
+
+    def reject(self, destination, delete_immediately):
+        if delete_immediately:
+            self.path.unlink()
+        else:
+            self.path.rename(Path(destination) / self.name)
+
+
+class PackedFrame:
+    # A frame stored in the pack of a session directory. The size and mtime
+    # are the length and offset of the frame data, which identify it just as
+    # well since the pack is only appended to. Any transform applied at
+    # capture comes from the sidecar.
+
+    def __init__(self, directory, entry):
+        self.directory = Path(directory)
+        self.entry = entry
+        self.name = '{0:06d}.{1}'.format(entry.index, entry.format)
+        self.size = entry.length
+        self.mtime = entry.offset
+        self.dimensions = (entry.width, entry.height)
+        self.timestamp = entry.timestamp
+        self.transform = None
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.directory / pack_name, self.name)
+
+    def open(self):
+        return Image.open(io.BytesIO(self.read_bytes()))
+
+    def read_bytes(self):
+        return read_frame_data(self.directory, self.entry)
+
+    def reject(self, destination, delete_immediately):
+        reject_frames([self], destination, delete_immediately)
+
+
+def _kept_copies(directory, index):
+    # The image files left beside a pack by pack --keep for a packed frame
+    for suffix in frame_suffixes:
+        path = Path(directory) / '{0:06d}{1}'.format(index, suffix)
+        if path.exists():
+            yield path
+
+
+def reject_frames(frames, destination, delete_immediately):
+    # Rejects a number of frames at once, so that the index of a pack is
+    # only rewritten once however many of its frames are rejected. Any copy
+    # of a packed frame kept beside the pack is removed too, so that it does
+    # not bring the frame back when the pack is unpacked.
+    packed = {}
+    for frame in frames:
+        if isinstance(frame, PackedFrame):
+            if not delete_immediately:
+                (Path(destination) / frame.name).write_bytes(
+                    frame.read_bytes()
+                )
+            for path in _kept_copies(frame.directory, frame.entry.index):
+                path.unlink()
+            packed.setdefault(frame.directory, []).append(frame.entry)
+        else:
+            frame.reject(destination, delete_immediately)
+    for directory, entries in packed.items():
+        mark_deleted(directory, entries)
+
+
+def list_frames(directory):
+    # All of the frames in a session directory, whether stored as files or in
+    # a pack, in sequence order. An image file for a frame that is also in
+    # the pack is a copy left by pack --keep, and is ignored.
+    frames = []
+    metadata = read_metadata(directory)
+    pack_entries = []
+    if is_packed(directory):
+        pack_entries = read_entries(directory)
+    packed_indices = set(entry.index for entry in pack_entries)
+    with os.scandir(str(directory)) as entries:
+        for entry in entries:
+            if (
+                entry.is_file()
+                and is_frame_file(Path(entry.name))
+                and int(Path(entry.name).stem) not in packed_indices
+            ):
+                frames.append(
+                    FileFrame(
+                        Path(entry.path),
+                        entry.stat(),
+                        metadata.get(entry.name)
+                    )
+                )
+    frames.sort(key=lambda frame: frame.name)
+    packed = []
+    for entry in pack_entries:
+        if not entry.flags & _flag_deleted:
+            frame = PackedFrame(directory, entry)
+            record = metadata.get(frame.name)
+            if record is not None and record.get('bytes') == frame.size:
+                frame.transform = record.get('transform')
+            packed.append(frame)
+    packed.sort(key=lambda frame: frame.entry.index)
+    return frames + packed
+
+
+def _session_directories(source, single):
+    source = Path(source)
+    if single:
+        return [source]
+    return sorted(child for child in source.iterdir() if child.is_dir())
+
+
+def _pack_directory(directory, keep):
+    # Returns the number of frames packed, and the number found, which
+    # includes any that were already in the pack.
+    frame_paths = sorted(
+        path for path in directory.iterdir()
+        if path.is_file() and is_frame_file(path)
+    )
+    if not frame_paths:
+        if not is_packed(directory):
+            return 0, 0
+        packed = sum(
+            1 for entry in read_entries(directory)
+            if not entry.flags & _flag_deleted
+        )
+        if packed:
+            print("The {0} frame(s) in {1} are already packed".format(
+                packed,
+                directory
+            ))
+        return 0, packed
+    writer = PackWriter(directory)
+    try:
+        # Frames that are already in the pack were kept by an earlier run
+        packed_indices = set(entry.index for entry in writer.entries)
+        new_paths = [
+            frame_path for frame_path in frame_paths
+            if int(frame_path.stem) not in packed_indices
+        ]
+        for frame_path in new_paths:
+            with Image.open(frame_path) as frame:
+                width, height = frame.size
+            writer.append(
+                int(frame_path.stem),
+                frame_path.read_bytes(),
+                frame_path.stat().st_mtime,
+                width,
+                height,
+                frame_path.suffix[1:].lower()
+            )
+        os.fsync(writer._pack_file.fileno())
+        os.fsync(writer._index_file.fileno())
+    finally:
+        writer.close()
+    if not keep:
+        for frame_path in frame_paths:
+            frame_path.unlink()
+    if not new_paths:
+        print("The {0} frame(s) in {1} are already packed".format(
+            len(frame_paths),
+            directory
+        ))
+    return len(new_paths), len(frame_paths)
+
+
+def _unpack_directory(directory):
+    if not is_packed(directory):
+        return 0, 0
+    count = 0
+    for entry in read_entries(directory):
+        if entry.flags & _flag_deleted:
+            # A copy kept by pack --keep would bring back a rejected frame
+            for path in _kept_copies(directory, entry.index):
+                path.unlink()
+            continue
+        frame_path = directory / '{0:06d}.{1}'.format(entry.index, entry.format)
+        frame_path.write_bytes(read_frame_data(directory, entry))
+        os.utime(str(frame_path), (entry.timestamp, entry.timestamp))
+        count += 1
+    (directory / pack_name).unlink()
+    try:
+        (directory / index_name).unlink()
+    except FileNotFoundError:
+        # The index was lost, and the frames were found from the pack alone
+        pass
+    return count, count
+
+
+def _verify_source(source):
+    p = Path(source)
+    if not p.exists():
+        raise FileNotFoundError()
+    else:
+        if p.is_file():
+            raise NotADirectoryError()
+
+
+def _run_command(args, operation, description):
+    global _debug
+    _debug = args.debug
+
+    try:
+        _verify_source(args.source)
+    except FileNotFoundError:
+        print ("The specified source does not exist.")
+        sys.exit(1)
+    except NotADirectoryError:
+        print ("The specified source is not a directory.")
+        sys.exit(1)
+
+    total = 0
+    try:
+        for directory in _session_directories(args.source, args.single):
+            count, found = operation(directory)
+            if count:
+                print("{0} {1} frame(s) in {2}".format(
+                    description,
+                    count,
+                    directory
+                ))
+            total += found
+    except ValueError as error:
+        print ("The frame pack could not be read (%s)." % error)
+        sys.exit(1)
+    except IOError as error:
+        print (error)
+        print ("An IO error occurred while processing the frames.")
+        sys.exit(1)
+
+    if total == 0:
+        print("No frames were found.")
+        sys.exit(1)
+
+
+def pack(args):
+    _run_command(
+        args,
+        lambda directory: _pack_directory(directory, args.keep),
+        "Packed"
+    )
+
+
+def unpack(args):
+    _run_command(args, _unpack_directory, "Unpacked")
@@ -0,0 +1,220 @@
+import sys
+import time
+import json
+import threading
+import contextlib
+import http.server
+
+
+# Counters and latency histograms shared by all of the commands. Recording
+# is cheap and always on, so that the summary can be printed whatever
+# happens. Histograms only keep bucket counts, so they stay the same size
+# however long a capture runs.
+
+_buckets = [
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+]
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_stream = None
+_server = None
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(_buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(_buckets) and value > _buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        self.maximum = max(self.maximum, value)
+
+    def percentile(self, percent):
+        # An estimate, interpolated linearly within the bucket the percentile
+        # falls in. The bucket is narrowed to the smallest and largest values
+        # seen, so that a stage whose times all fall in one bucket still gets
+        # a useful figure.
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                lower = _buckets[index - 1] if index > 0 else 0.0
+                upper = (
+                    _buckets[index] if index < len(_buckets) else self.maximum
+                )
+                lower = max(lower, self.minimum)
+                upper = min(upper, self.maximum)
+                fraction = max(rank - seen, 0) / count
+                return lower + (upper - lower) * fraction
+            seen += count
+        return self.maximum
+
+
+def _write_event(event):
+    if _stream is not None:
+        event['time'] = time.time()
+        _stream.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        _write_event({'type': 'count', 'name': name, 'value': value})
+
+
+def observe(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _Histogram()
+            _histograms[name] = histogram
+        histogram.observe(seconds)
+        _write_event({'type': 'observe', 'name': name, 'value': seconds})
+
+
+@contextlib.contextmanager
+def timer(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start)
+
+
+def _prometheus_text():
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            lines.append('# TYPE timelapse_{0}_total counter'.format(name))
+            lines.append('timelapse_{0}_total {1}'.format(name, value))
+        for name, histogram in sorted(_histograms.items()):
+            metric = 'timelapse_{0}_seconds'.format(name)
+            lines.append('# TYPE {0} histogram'.format(metric))
+            cumulative = 0
+            for bound, bucket_count in zip(
+                [str(bound) for bound in _buckets] + ['+Inf'],
+                histogram.counts
+            ):
+                cumulative += bucket_count
+                lines.append(
+                    '{0}_bucket{{le="{1}"}} {2}'.format(
+                        metric,
+                        bound,
+                        cumulative
+                    )
+                )
+            lines.append('{0}_sum {1}'.format(metric, histogram.total))
+            lines.append('{0}_count {1}'.format(metric, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = _prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def configure(stream_path=None, port=None):
+    # Optionally streams every measurement to a file as JSON lines, and
+    # serves the current totals for Prometheus on localhost.
+    global _stream, _server
+    if stream_path is not None:
+        _stream = open(stream_path, 'a', buffering=1, encoding='utf-8')
+    if port is not None:
+        _server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', port),
+            _MetricsHandler
+        )
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+
+
+def close():
+    global _stream, _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    with _lock:
+        if _stream is not None:
+            _stream.close()
+            _stream = None
+
+
+def print_summary(file=sys.stdout):
+    with _lock:
+        if not _counters and not _histograms:
+            return
+        print("Statistics:", file=file)
+        for name, value in sorted(_counters.items()):
+            print("  {0}: {1}".format(name, value), file=file)
+        if _histograms:
+            print(
+                "  {0:<16}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}".format(
+                    "stage",
+                    "count",
+                    "mean ms",
+                    "p50 ms",
+                    "p90 ms",
+                    "max ms"
+                ),
+                file=file
+            )
+        for name, histogram in sorted(_histograms.items()):
+            print(
+                "  {0:<16}{1:>8}{2:>10.2f}{3:>10.2f}{4:>10.2f}{5:>10.2f}"
+                .format(
+                    name,
+                    histogram.count,
+                    histogram.total / histogram.count * 1000,
+                    histogram.percentile(50) * 1000,
+                    histogram.percentile(90) * 1000,
+                    histogram.maximum * 1000
+                ),
+                file=file
+            )
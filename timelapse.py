@@ -5,6 +5,8 @@ import argparse
 from capture import capture
 from clean import clean
 from convert import convert
+from framestore import pack, unpack
+import metrics
 
 def _parse_arguments():
     parser = argparse.ArgumentParser(
@@ -16,6 +18,30 @@ def _parse_arguments():
         dest="debug",
         help="print debugging information"
     )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        dest="stats",
+        help="print counts and timings for each stage of the command on exit"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar='FILE',
+        dest="metrics_file",
+        action="store",
+        help="append every measurement to a file as JSON lines"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        metavar='PORT',
+        dest="metrics_port",
+        action="store",
+        type=int,
+        help=(
+            "serve the measurements for Prometheus at"
+            " http://127.0.0.1:PORT/metrics"
+        )
+    )
     subparsers = parser.add_subparsers(dest='command')
 
     # Capture command
@@ -43,7 +69,7 @@ def _parse_arguments():
         dest="interval",
         action="store",
         default=3,
-        type=int,
+        type=float,
         help="the period between screenshots, in seconds"
     )
     capture_parser.add_argument(
@@ -55,6 +81,220 @@ def _parse_arguments():
             " sequence instead of storing separate sessions in subdirectories"
         )
     )
+    capture_parser.add_argument(
+        "--workers",
+        metavar='N',
+        dest="workers",
+        action="store",
+        default=2,
+        type=int,
+        help="the number of threads used to encode and write screenshots"
+    )
+    capture_parser.add_argument(
+        "--queue-depth",
+        metavar='N',
+        dest="queue_depth",
+        action="store",
+        default=8,
+        type=int,
+        help="the number of screenshots that can be waiting to be written"
+    )
+    capture_parser.add_argument(
+        "--backpressure",
+        dest="backpressure",
+        action="store",
+        default="block",
+        choices=["block", "drop-oldest", "drop-newest"],
+        help=(
+            "what to do with a new screenshot when the write queue is full"
+            " (default: block)"
+        )
+    )
+    capture_parser.add_argument(
+        "--backend",
+        dest="backend",
+        action="store",
+        default="auto",
+        choices=["auto", "xlib", "pyscreenshot"],
+        help=(
+            "the method used to grab screenshots (default: auto, which reads"
+            " directly from the X server when possible)"
+        )
+    )
+    capture_parser.add_argument(
+        "--dedup",
+        dest="dedup",
+        action="store_true",
+        help="skip screenshots that are unchanged from the last one stored"
+    )
+    capture_parser.add_argument(
+        "--dedup-threshold",
+        metavar='T',
+        dest="dedup_threshold",
+        action="store",
+        default=4,
+        type=int,
+        help=(
+            "the largest difference in brightness (0-255) of any part of a"
+            " screenshot for it to still count as unchanged (default: 4)"
+        )
+    )
+    capture_parser.add_argument(
+        "--specification",
+        metavar='S',
+        dest="specification",
+        type=str,
+        action="store",
+        nargs="+",
+        help=(
+            "specification(s) that screenshots must pass to be stored, as for"
+            " the clean command"
+        )
+    )
+    capture_parser.add_argument(
+        "--rejected",
+        metavar='D',
+        dest="rejected",
+        type=str,
+        action="store",
+        default=None,
+        help=(
+            "directory to store screenshots rejected by the specifications in,"
+            " instead of discarding them"
+        )
+    )
+    capture_parser.add_argument(
+        "--live",
+        dest="live",
+        action="store_true",
+        help=(
+            "encode screenshots straight into video segments instead of"
+            " storing them as images"
+        )
+    )
+    capture_parser.add_argument(
+        "--live-framerate",
+        metavar='F',
+        dest="live_framerate",
+        action="store",
+        default=20,
+        type=int,
+        help="the framerate of the video segments recorded with --live"
+    )
+    capture_parser.add_argument(
+        "--segment-time",
+        metavar='S',
+        dest="segment_time",
+        action="store",
+        default=60,
+        type=int,
+        help="the length of each video segment recorded with --live, in seconds"
+    )
+    capture_parser.add_argument(
+        "--live-format",
+        dest="live_format",
+        action="store",
+        default="mkv",
+        choices=["mkv", "mp4"],
+        help="the container format of the video segments (default: mkv)"
+    )
+    capture_parser.add_argument(
+        "--live-resize",
+        dest="live_resize",
+        action="store",
+        default="restart",
+        choices=["restart", "scale"],
+        help=(
+            "what to do when the window size changes while recording with"
+            " --live: start a new segment, or scale to the current size"
+            " (default: restart)"
+        )
+    )
+    capture_parser.add_argument(
+        "--each-window",
+        dest="each_window",
+        action="store_true",
+        help=(
+            "capture a window matching each title at the same time, whether"
+            " it has the focus or not, each into its own sequence"
+        )
+    )
+    capture_parser.add_argument(
+        "--pack",
+        dest="pack",
+        action="store_true",
+        help=(
+            "store screenshots in a single indexed frame pack per session"
+            " instead of a file each"
+        )
+    )
+    capture_parser.add_argument(
+        "--format",
+        dest="frame_format",
+        action="store",
+        default="png",
+        choices=["png", "webp", "bmp", "tiff"],
+        help="the lossless image format to store screenshots in (default: png)"
+    )
+    capture_parser.add_argument(
+        "--compress-level",
+        metavar='L',
+        dest="compress_level",
+        action="store",
+        default=6,
+        type=int,
+        choices=range(10),
+        help=(
+            "how hard to compress screenshots, from 0 (fastest) to 9"
+            " (smallest) (default: 6)"
+        )
+    )
+    capture_parser.add_argument(
+        "--png-strategy",
+        dest="png_strategy",
+        action="store",
+        default="filtered",
+        choices=["default", "filtered", "rle", "huffman"],
+        help=(
+            "the zlib strategy to compress PNG screenshots with; rle and"
+            " huffman are quicker (default: filtered)"
+        )
+    )
+    capture_parser.add_argument(
+        "--crop",
+        metavar='X,Y,W,H',
+        dest="crop",
+        type=str,
+        action="store",
+        default=None,
+        help=(
+            "store only this region of the window, given by the position of"
+            " its top left corner relative to the window and its size"
+        )
+    )
+    capture_parser.add_argument(
+        "--max-size",
+        metavar='WxH',
+        dest="max_size",
+        type=str,
+        action="store",
+        default=None,
+        help=(
+            "scale screenshots down to fit within this size before storing"
+            " them, keeping their aspect ratio"
+        )
+    )
+    capture_parser.add_argument(
+        "--resample",
+        dest="resample",
+        action="store",
+        default="box",
+        choices=["nearest", "box", "bilinear", "bicubic", "lanczos"],
+        help=(
+            "the filter used to scale screenshots down with --max-size, from"
+            " fastest to smoothest (default: box)"
+        )
+    )
 
     clean_parser = subparsers.add_parser(
         'clean',
@@ -103,6 +343,24 @@ def _parse_arguments():
         dest="test",
         help="check the rules but do not move or delete the frames"
     )
+    clean_parser.add_argument(
+        "-j", "--jobs",
+        metavar='N',
+        dest="jobs",
+        action="store",
+        default=None,
+        type=int,
+        help=(
+            "the number of processes used to check frames (default: the"
+            " number of CPUs)"
+        )
+    )
+    clean_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        dest="no_cache",
+        help="check every frame, even if it was checked by a previous run"
+    )
 
     compile_parser = subparsers.add_parser(
         'convert', aliases=['con'],
@@ -149,6 +407,113 @@ def _parse_arguments():
         dest="skip_pad_clip",
         help="skip creation of a padding clip based  on the final frame"
     )
+    compile_parser.add_argument(
+        "--inline-pad",
+        action="store_true",
+        dest="inline_pad",
+        help=(
+            "hold the final frame at the end of the last clip instead of"
+            " creating a separate padding clip"
+        )
+    )
+    compile_parser.add_argument(
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help=(
+            "decode the frames and pipe them to ffmpeg, instead of having"
+            " ffmpeg read the image files itself"
+        )
+    )
+    compile_parser.add_argument(
+        "--timestamps",
+        action="store_true",
+        dest="timestamps",
+        help=(
+            "follow the times the frames were captured at, instead of showing"
+            " each frame for the same length of time"
+        )
+    )
+    compile_parser.add_argument(
+        "-j", "--jobs",
+        metavar='N',
+        dest="jobs",
+        action="store",
+        default=1,
+        type=int,
+        help="the number of clips to encode at the same time"
+    )
+    compile_parser.add_argument(
+        "--force",
+        action="store_true",
+        dest="force",
+        help="prepare every clip, even those that are unchanged"
+    )
+    compile_parser.add_argument(
+        "--join",
+        action="store_true",
+        dest="join",
+        help="join the clips into a single video in the destination directory"
+    )
+    compile_parser.add_argument(
+        "--join-name",
+        metavar='FILE',
+        dest="join_name",
+        action="store",
+        default="timelapse.mp4",
+        help="the file name of the joined video (default: timelapse.mp4)"
+    )
+    compile_parser.add_argument(
+        "-p", "--profile",
+        metavar='P',
+        dest="profile",
+        action="store",
+        default="default",
+        help=(
+            "the encoding profile to use, such as draft or archive"
+            " (default: default)"
+        )
+    )
+
+    pack_parser = subparsers.add_parser(
+        'pack',
+        help="store the frames of image sequences in frame packs"
+    )
+    pack_parser.add_argument(
+        "source",
+        type=str,
+        action="store",
+        help="source directory for image sequences"
+    )
+    pack_parser.add_argument(
+        "-s", "--single",
+        action="store_true",
+        dest="single",
+        help="only pack the specified directory instead of looking for subdirectories"
+    )
+    pack_parser.add_argument(
+        "--keep",
+        action="store_true",
+        dest="keep",
+        help="keep the image files after packing them"
+    )
+
+    unpack_parser = subparsers.add_parser(
+        'unpack',
+        help="extract the frames of frame packs into image files"
+    )
+    unpack_parser.add_argument(
+        "source",
+        type=str,
+        action="store",
+        help="source directory for image sequences"
+    )
+    unpack_parser.add_argument(
+        "-s", "--single",
+        action="store_true",
+        dest="single",
+        help="only unpack the specified directory instead of looking for subdirectories"
+    )
 
     args = parser.parse_args()
     return args
@@ -158,6 +523,11 @@ def _main():
     args = _parse_arguments()
     global _debug
     _debug = args.debug
+    try:
+        metrics.configure(args.metrics_file, args.metrics_port)
+    except OSError as error:
+        print ("The metrics output could not be set up (%s)." % error)
+        sys.exit(1)
     try:
         if args.command in ['capture', 'cap']:
             capture(args)
@@ -165,13 +535,20 @@ def _main():
             clean(args)
         elif args.command in ['convert', 'con']:
             convert(args)
+        elif args.command in ['pack']:
+            pack(args)
+        elif args.command in ['unpack']:
+            unpack(args)
     except KeyboardInterrupt:
-        # TODO: Maybe track some statistics and print them on exit.
         # Redisplay the cursor
         sys.stdout.write("\x1b[?25h")
         sys.stdout.flush()
         print()
         sys.exit(0)
+    finally:
+        if args.stats:
+            metrics.print_summary()
+        metrics.close()
 
 
 if __name__ == "__main__":